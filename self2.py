@@ -1,25 +1,45 @@
 # index.py
 
 import os
+import stat # For checking file types from os.stat results
 import asyncio
 import logging
+import logging.handlers # For QueueHandler/QueueListener (non-blocking log sinks)
+import queue
+import atexit
 import time
+import signal # For SIGINT/SIGTERM shutdown handling
 import math
 import re
-from datetime import datetime, timedelta
+import mimetypes # For mapping Content-Type headers to file extensions
+from datetime import datetime, timedelta, timezone
 import random
+import tempfile # For temp files written from worker threads
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor # Dedicated worker threads for blocking libraries
 import io # For in-memory file operations
 from PIL import Image, ImageDraw, ImageFont # For image manipulations
 import aiohttp # For asynchronous HTTP requests to external APIs
+import aiofiles.tempfile # For streaming large outputs to disk without blocking the loop
 from googletrans import Translator, LANGUAGES # For translation
 import wikipediaapi # For Wikipedia searches
 import requests # For synchronous HTTP requests (if needed, but aiohttp is preferred)
 from bs4 import BeautifulSoup # For web scraping (if needed)
-from typing import Dict, Any, Optional, List, Union # For advanced Type Hinting
-from functools import wraps # For decorators
+from typing import Dict, Any, Optional, List, Tuple, Union # For advanced Type Hinting
+from functools import wraps, lru_cache, cache # For decorators and memoized template parsing
+import contextlib
+from contextlib import asynccontextmanager # For the deferred progress-message helper
+from cachetools import TTLCache # In-memory caches for hot-path DB lookups
+from aiolimiter import AsyncLimiter # Token bucket for pacing bulk Telegram writes
 
 # Database Integration (SQLModel/SQLite)
 from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession # Non-blocking sessions for handlers
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import make_url # For deriving the async driver URL from DATABASE_URL
+from sqlalchemy import Column, DateTime, Index, Row, TypeDecorator, bindparam, event, func, inspect, insert, or_, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert # For single-statement UPSERTs
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from typing import Optional
 
 # Additional libraries for new commands
@@ -29,18 +49,21 @@ import psutil # For system monitoring and uptime details
 import qrcode # For QR code generation
 import pyfiglet # For Figlet text
 from spellchecker import SpellChecker # For spell correction (pip install pyspellchecker)
+from gtts import gTTS # For text-to-speech (.tovoice)
 import base64 # For Base64 encoding/decoding
+from urllib.parse import urlsplit # For extracting the path from download URLs
 
-from pyrogram import Client, filters, idle
+from pyrogram import Client, filters
 from pyrogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
-    ChatPermissions, ForceReply, InputMediaPhoto, InputMediaVideo
+    ChatPermissions, ForceReply, InputMediaPhoto, InputMediaVideo, User,
+    ChatMember, ChatMemberUpdated
 )
-from pyrogram.enums import ChatAction, MessageEntityType
+from pyrogram.enums import ChatAction, ChatMemberStatus, ChatType, MessageEntityType
 from pyrogram.errors import (
     FloodWait, RPCError, UserNotParticipant, PeerIdInvalid,
     UserAdminInvalid, ChatAdminRequired, BadRequest, MessageIdInvalid,
-    Forbidden
+    Forbidden, SlowmodeWait
 )
 from dotenv import load_dotenv
 
@@ -51,12 +74,19 @@ from dotenv import load_dotenv
 # -------------------------------------------------------------------------
 # Logging Configuration
 # Sets up detailed logging to a file and console for debugging and monitoring.
-# -------------------------------------------------------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler("userbot.log"), logging.StreamHandler()]
-)
+# Records are pushed onto a queue and written by a background listener thread,
+# so file/console I/O never runs on the event loop.
+# -------------------------------------------------------------------------
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_sinks: List[logging.Handler] = [logging.FileHandler("userbot.log"), logging.StreamHandler()]
+for _sink in _log_sinks:
+    _sink.setFormatter(_log_formatter)
+
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+log_listener = logging.handlers.QueueListener(_log_queue, *_log_sinks, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop) # Flush queued records on interpreter exit
 logger = logging.getLogger(__name__)
 
 logger.info("Starting userbot initialization...")
@@ -104,6 +134,9 @@ logger.info(f"Command prefix: '{COMMAND_PREFIX}'")
 # Global start time for uptime calculation
 START_TIME: float = time.time()
 
+# The account's first name, cached once at startup (see main_runner)
+ME_FIRST_NAME: Optional[str] = None
+
 # =========================================================================
 # SECTION 2: GLOBAL VARIABLES AND DATABASE INTEGRATION
 # This section defines global states and sets up SQLite database for persistence.
@@ -126,21 +159,157 @@ AFK_MESSAGE_COOLDOWN: int = 60 # seconds, how often to reply to a user while AFK
 # Defines database models and initializes the engine.
 # -------------------------------------------------------------------------
 DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///userbot.db")
-engine = create_engine(DATABASE_URL)
+# Keep a few connections warm (no connect per session) and drop ones that died while idle
+engine = create_engine(DATABASE_URL, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=1800)
+
+# Async engine for handlers on the hot path, so DB I/O yields to the event loop
+# instead of blocking it. It points at the same database as DATABASE_URL, through the
+# async driver for its backend; set ASYNC_DATABASE_URL in .env to override the derived URL.
+ASYNC_DRIVERS: Dict[str, str] = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def derive_async_database_url(url: str) -> Optional[str]:
+    """
+    Returns `url` rewritten to use the async driver for its backend, or None if no async driver is known.
+    """
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None:
+        return None
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL: Optional[str] = os.getenv("ASYNC_DATABASE_URL") or derive_async_database_url(DATABASE_URL)
+if not ASYNC_DATABASE_URL:
+    logger.critical(
+        "No async driver is known for DATABASE_URL '%s'. Set ASYNC_DATABASE_URL in your .env file.",
+        make_url(DATABASE_URL).render_as_string(hide_password=True)
+    )
+    sys.exit(1)
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+# SQLite tuning: WAL lets readers run alongside the writer, and synchronous=NORMAL
+# skips the fsync on every commit (still durable across application crashes).
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456", # 256 MiB
+)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Applies SQLITE_PRAGMAS to every new SQLite connection.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS: # The sqlite3 driver runs one statement per execute()
+        cursor.execute(pragma)
+    cursor.close()
+
+for _engine in (engine, async_engine.sync_engine):
+    if _engine.dialect.name == "sqlite":
+        event.listen(_engine, "connect", set_sqlite_pragmas)
 
 # Ensure database tables are created on startup
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    recreate_changed_indexes()
+    # create_all() skips indexes on tables that already exist; add any that are missing
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    add_missing_columns()
     logger.info("Database and tables created/checked.")
 
+def recreate_changed_indexes():
+    """
+    Drops and recreates existing indexes whose uniqueness or columns differ from the model.
+    index.create(checkfirst=True) only compares names, so e.g. the formerly UNIQUE
+    ix_usersetting_user_id would otherwise keep allowing just one setting per user.
+    """
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"]: index for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            found = existing.get(index.name)
+            if found is None:
+                continue
+            if bool(found["unique"]) == bool(index.unique) and found["column_names"] == [column.name for column in index.columns]:
+                continue
+            index.drop(engine)
+            index.create(engine)
+            logger.info("Recreated index %s on %s to match the model.", index.name, table.name)
+
+def add_missing_columns():
+    """
+    Adds columns declared on a model but missing from its existing table (create_all() never alters tables).
+    Only columns that existing rows can take are added: nullable ones, or NOT NULL ones with a server default.
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    ddl_compiler = engine.dialect.ddl_compiler(engine.dialect, None)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                default = ddl_compiler.get_column_default_string(column)
+                if column.name in existing or (not column.nullable and default is None):
+                    continue
+                column_spec = f"{quote(column.name)} {column.type.compile(dialect=engine.dialect)}"
+                if default is not None:
+                    column_spec += f" DEFAULT {default}"
+                if not column.nullable:
+                    column_spec += " NOT NULL"
+                conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {column_spec}"))
+                logger.info("Added missing column %s.%s.", table.name, column.name)
+
+def utc_now() -> datetime:
+    """
+    Returns the current time as a timezone-aware UTC datetime.
+    """
+    return datetime.now(timezone.utc)
+
+class UTCDateTime(TypeDecorator):
+    """
+    DateTime column that always hands back timezone-aware UTC datetimes.
+    SQLite drops the offset on write, so there values are stored as naive UTC and tagged on read;
+    other dialects (TIMESTAMP WITH TIME ZONE) get aware UTC values, since drivers such as asyncpg
+    and psycopg would read a naive value as host- or session-local time.
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        value = value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+        if dialect.name == "sqlite":
+            value = value.replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
 # Database Models
 class UserSetting(SQLModel, table=True):
+    # One row per (user, key); also serves the `user_id == X AND key == Y` lookups
+    __table_args__ = (Index("ix_usersetting_user_key", "user_id", "key", unique=True),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(index=True, unique=True)
+    user_id: int = Field(index=True)
     key: str
     value: str
 
 class ChatSetting(SQLModel, table=True):
+    # One row per (chat, key); also serves the `chat_id == X AND key == Y` lookups
+    __table_args__ = (Index("ix_chatsetting_chat_key", "chat_id", "key", unique=True),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     chat_id: int = Field(index=True)
     key: str
@@ -154,13 +323,21 @@ class AFKState(SQLModel, table=True):
     start_time: Optional[float] = None # Unix timestamp
 
 class Reminder(SQLModel, table=True):
+    # Serves the due-reminder scan (`is_active AND remind_time <= now`) and the next-deadline lookup
+    __table_args__ = (Index("ix_rem_due", "is_active", "remind_time"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int
     chat_id: int
     message_id: int # Original message ID to reply to or context
-    remind_time: datetime
+    remind_time: datetime = Field(sa_column=Column(UTCDateTime, nullable=False))
     text: str
+    # Final message text, formatted once at creation so the dispatcher only passes it through (NULL on legacy rows)
+    rendered_text: Optional[str] = None
     is_active: bool = True
+    # Transient send failures so far, and when the next attempt is allowed (NULL: no backoff pending)
+    retry_count: int = Field(default=0, sa_column_kwargs={"server_default": text("0")})
+    next_retry_at: Optional[datetime] = Field(default=None, sa_column=Column(UTCDateTime, nullable=True))
 
 class Note(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -170,20 +347,45 @@ class Note(SQLModel, table=True):
     content: str
 
 class Warning(SQLModel, table=True):
+    __table_args__ = (Index("ix_warning_user_chat_time", "user_id", "chat_id", "timestamp"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int
     chat_id: int
     admin_id: int
+    # Denormalized at write time so listing warnings needs no per-admin lookup (NULL on legacy rows)
+    admin_first_name: Optional[str] = None
+    admin_username: Optional[str] = None
     reason: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=utc_now, sa_column=Column(UTCDateTime, nullable=False))
 
 class ScheduledMessage(SQLModel, table=True):
+    # Serves the due-message scan (`NOT is_sent AND send_time <= now`) and the next-deadline lookup
+    __table_args__ = (Index("ix_sched_due", "is_sent", "send_time"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int # The user who scheduled it (the userbot's owner)
     chat_id: int # The chat where it should be sent
-    send_time: datetime
+    send_time: datetime = Field(sa_column=Column(UTCDateTime, nullable=False))
     message_text: str
+    # Final message text, formatted once at creation so the dispatcher only passes it through (NULL on legacy rows)
+    rendered_text: Optional[str] = None
     is_sent: bool = False
+    # Transient send failures so far, and when the next attempt is allowed (NULL: no backoff pending)
+    retry_count: int = Field(default=0, sa_column_kwargs={"server_default": text("0")})
+    next_retry_at: Optional[datetime] = Field(default=None, sa_column=Column(UTCDateTime, nullable=True))
+
+def render_reminder_text(text: str) -> str:
+    """
+    Formats the message sent when a reminder fires.
+    """
+    return f"**🔔 REMINDER:** `{text}`"
+
+def render_scheduled_text(message_text: str) -> str:
+    """
+    Formats the message sent for a scheduled message.
+    """
+    return f"**⏰ Scheduled Reminder:**\n`{message_text}`"
 
 # Initialize database tables
 create_db_and_tables()
@@ -206,6 +408,23 @@ wiki_wiki_fa = wikipediaapi.Wikipedia('fa') # Wikipedia client for Farsi
 wiki_wiki_en = wikipediaapi.Wikipedia('en') # Wikipedia client for English
 spell = SpellChecker() # Spell checker instance
 
+# Chat settings read on every group message/join (antilink, welcome, antiflood),
+# keyed by (chat_id, key). Missing settings are cached as None so quiet chats
+# don't hit the DB either. Writers update the cache right after committing.
+chat_setting_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+# Global ban reasons keyed by user_id (None = not globally banned).
+gban_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+# Telegram User objects keyed by user_id, for repeated lookups (e.g. warning admins).
+user_cache: TTLCache = TTLCache(maxsize=5_000, ttl=600)
+# Results of check_userbot_rights_in_chat keyed by (chat_id, permissions). Entries for a
+# chat are evicted when the userbot's own membership there changes.
+rights_cache: TTLCache = TTLCache(maxsize=50_000, ttl=60)
+_MISSING = object() # Sentinel for cache misses (None is a valid cached value)
+
+# Wake-up signal for the background dispatcher: set by the commands that create
+# scheduled messages/reminders so a new row is picked up without waiting out a sleep.
+due_wakeup = asyncio.Event()
+
 # =========================================================================
 # SECTION 3: CENTRALIZED COMMAND DEFINITION (`COMMANDS` Dictionary)
 # This dictionary is the core of your help panel and command recognition.
@@ -306,7 +525,7 @@ COMMANDS: Dict[str, Dict[str, str]] = {
         "imgedit [rotate/resize] [value] [reply]": "Performs basic image edits (rotate, resize).",
         "tofile [reply]": "Converts a media message to a document file.",
         "tosticker [reply]": "Converts a photo to a static sticker.",
-        "tovoice [reply]": "Converts a text message to a voice message (TTS - simulated)."
+        "tovoice [reply]": "Converts a text message to a voice message (TTS)."
     },
     "Developer": {
         # eval/exec are in General for convenience, but truly developer-centric
@@ -317,6 +536,19 @@ COMMANDS: Dict[str, Dict[str, str]] = {
 # =========================================================================
 # SECTION 4: CORE HELPER FUNCTIONS
 # These functions encapsulate common logic to avoid code repetition.
+# -------------------------------------------------------------------------
+def missing_admin_rights(member: ChatMember, permissions: List[str]) -> List[str]:
+    """
+    Returns the entries of `permissions` that `member` lacks. 'admin' means any administrator.
+    The owner has every right; an administrator's rights are read from `member.privileges`.
+    """
+    if member.status == ChatMemberStatus.OWNER:
+        return []
+    privileges = member.privileges if member.status == ChatMemberStatus.ADMINISTRATOR else None
+    if privileges is None:
+        return list(permissions)
+    return [perm for perm in permissions if perm != 'admin' and not getattr(privileges, perm, False)]
+
 # -------------------------------------------------------------------------
 # Admin Permissions Checker Decorator
 # A decorator to check if the userbot has specific admin rights in a chat.
@@ -325,20 +557,17 @@ def require_admin_rights(permissions: List[str]):
     def decorator(func):
         @wraps(func)
         async def wrapper(client: Client, message: Message, *args, **kwargs):
-            if not message.chat.type in ["group", "supergroup"]:
+            if message.chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
                 await message.edit("`This command only works in groups.`")
                 return
 
             try:
                 me_member = await client.get_chat_member(message.chat.id, client.me.id)
                 
-                missing_perms = []
-                for perm in permissions:
-                    # Special handling for 'admin' implies full rights
-                    if perm == 'admin' and not me_member.status.ADMINISTRATOR:
-                        missing_perms.append('Administrator')
-                    elif not getattr(me_member, perm, False):
-                        missing_perms.append(perm.replace("can_", "").replace("_", " ").title())
+                missing_perms = [
+                    'Administrator' if perm == 'admin' else perm.replace("can_", "").replace("_", " ").title()
+                    for perm in missing_admin_rights(me_member, permissions)
+                ]
                 
                 if missing_perms:
                     await message.edit(
@@ -365,6 +594,48 @@ def require_admin_rights(permissions: List[str]):
         return wrapper
     return decorator
 
+# -------------------------------------------------------------------------
+# Telegram Rate-Limit Handling
+# Retries Telegram API calls on FloodWait (honouring the server's wait time) and,
+# for idempotent calls only, on transient network errors (capped exponential backoff
+# with jitter). A send that timed out may still have been delivered, so sends are
+# retried on FloodWait alone.
+# -------------------------------------------------------------------------
+TG_MAX_ATTEMPTS: int = 5
+TG_BACKOFF_BASE: float = 1.0 # seconds
+TG_BACKOFF_CAP: float = 30.0 # seconds
+
+# Token bucket shared by bulk write loops (e.g. .gban fan-out): only actual API
+# writes consume a token, and concurrent workers are paced together.
+TG_WRITE_RATE: int = 20 # writes per second
+tg_write_limiter = AsyncLimiter(max_rate=TG_WRITE_RATE, time_period=1.0)
+
+def with_tg_backoff(func, idempotent: bool = False):
+    """
+    Wraps a Telegram API coroutine function so it is retried on FloodWait, and also on
+    transient network errors when `idempotent` is True (e.g. bans, restrictions).
+    Usage: await with_tg_backoff(client.send_message)(chat_id, text)
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(1, TG_MAX_ATTEMPTS + 1):
+            try:
+                return await func(*args, **kwargs)
+            except FloodWait as e:
+                if attempt == TG_MAX_ATTEMPTS:
+                    raise
+                delay = e.value + random.uniform(0, 1)
+            except (asyncio.TimeoutError, OSError):
+                if not idempotent or attempt == TG_MAX_ATTEMPTS:
+                    raise
+                delay = random.uniform(0, min(TG_BACKOFF_CAP, TG_BACKOFF_BASE * 2 ** attempt))
+            logger.warning(
+                "Telegram call %s throttled/failed, retrying in %.1fs (attempt %s/%s).",
+                func.__name__, delay, attempt, TG_MAX_ATTEMPTS
+            )
+            await asyncio.sleep(delay)
+    return wrapper
+
 
 async def get_reply_text(message: Message) -> Optional[str]:
     """
@@ -425,20 +696,148 @@ def format_time_difference(seconds: float) -> str:
 async def check_userbot_rights_in_chat(chat_id: int, permissions: List[str]) -> bool:
     """
     Checks if the userbot has the specified admin permissions in a given chat.
+    Results are cached in `rights_cache` to avoid a get_chat_member call per check.
     """
+    cache_key = (chat_id, tuple(sorted(permissions)))
+    has_rights = rights_cache.get(cache_key)
+    if has_rights is not None:
+        return has_rights
+
     try:
         me_member = await app.get_chat_member(chat_id, app.me.id)
-        for perm in permissions:
-            if perm == 'admin' and not me_member.status.ADMINISTRATOR:
-                return False
-            elif not getattr(me_member, perm, False):
-                return False
-        return True
+        has_rights = not missing_admin_rights(me_member, permissions)
     except ChatAdminRequired:
-        return False
+        has_rights = False
     except Exception as e:
         logger.error(f"Error checking bot permissions in chat {chat_id}: {e}", exc_info=True)
-        return False
+        return False # Not cached: the error may be transient
+
+    rights_cache[cache_key] = has_rights
+    return has_rights
+
+def invalidate_rights_cache(chat_id: int) -> None:
+    """
+    Drops all cached rights checks for a chat.
+    """
+    for cache_key in [key for key in list(rights_cache.keys()) if key[0] == chat_id]:
+        rights_cache.pop(cache_key, None)
+
+async def get_chat_setting_value(chat_id: int, key: str) -> Optional[str]:
+    """
+    Returns a ChatSetting value for a chat, served from `chat_setting_cache` when possible.
+    """
+    value = chat_setting_cache.get((chat_id, key), _MISSING)
+    if value is _MISSING:
+        async with async_session() as session:
+            chat_setting = (await session.exec(
+                select(ChatSetting).where(ChatSetting.chat_id == chat_id, ChatSetting.key == key)
+            )).first()
+        value = chat_setting.value if chat_setting else None
+        chat_setting_cache[(chat_id, key)] = value
+    return value
+
+async def upsert_setting(session: AsyncSession, model: type, owner_field: str, owner_id: int, key: str, value: str) -> None:
+    """
+    Inserts a UserSetting/ChatSetting row, or updates its value if the (owner, key) pair
+    already exists, in a single INSERT ... ON CONFLICT DO UPDATE statement.
+    The caller commits.
+    """
+    dialect_insert = postgresql_insert if async_engine.dialect.name == "postgresql" else sqlite_insert
+    stmt = dialect_insert(model).values({owner_field: owner_id, "key": key, "value": value})
+    stmt = stmt.on_conflict_do_update(index_elements=[owner_field, "key"], set_={"value": stmt.excluded.value})
+    await session.execute(stmt)
+
+async def get_users_cached(client: Client, user_ids: List[int]) -> Dict[int, User]:
+    """
+    Resolves user IDs to User objects, using `user_cache` and a single batched
+    get_users call for the IDs that aren't cached. Unresolvable IDs are omitted:
+    if the batch fails on one of them, the rest are looked up one by one.
+    """
+    users: Dict[int, User] = {}
+    for user_id in set(user_ids):
+        user = user_cache.get(user_id)
+        if user is not None:
+            users[user_id] = user
+    missing = [user_id for user_id in set(user_ids) if user_id not in users]
+    if not missing:
+        return users
+    try:
+        resolved = await client.get_users(missing)
+    except (BadRequest, KeyError) as e:
+        # get_users resolves every peer up front, so one stale ID fails the whole batch
+        logger.debug("Batched get_users failed (%s); resolving %s users one by one", e, len(missing))
+        resolved = []
+        for user_id in missing:
+            try:
+                resolved.append(await client.get_users(user_id))
+            except (BadRequest, KeyError) as e:
+                logger.debug("Skipping unresolvable user %s: %s", user_id, e)
+    for user in resolved:
+        user_cache[user.id] = user
+        users[user.id] = user
+    return users
+
+# Shared HTTP session: keeps TCP/TLS connections and DNS lookups alive across commands.
+# Created lazily because aiohttp sessions must be created inside the running event loop.
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared aiohttp session, creating it on first use.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30), # No total cap, so large downloads can stream
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+        )
+    return _http_session
+
+async def close_http_session() -> None:
+    """
+    Closes the shared aiohttp session, if it was ever opened.
+    """
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+PROGRESS_EDIT_DELAY: float = 0.8 # seconds before a "working on it..." edit is shown
+
+@asynccontextmanager
+async def deferred_progress(message: Message, text: str, delay: float = PROGRESS_EDIT_DELAY):
+    """
+    Edits `message` to `text` only if the wrapped work is still running after `delay` seconds,
+    so fast commands skip the extra round trip. Yields a coroutine function that cancels the
+    pending edit; await it before editing the message with a result inside the block.
+    """
+    async def show_progress() -> None:
+        await asyncio.sleep(delay)
+        try:
+            await message.edit(text)
+        except Exception as e:
+            logger.debug("Progress edit failed: %s", e)
+
+    progress_task = asyncio.create_task(show_progress())
+
+    async def finish_progress() -> None:
+        progress_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await progress_task
+
+    try:
+        yield finish_progress
+    finally:
+        await finish_progress()
+
+async def remove_file(path: Optional[str]) -> None:
+    """
+    Deletes a scratch file in a worker thread, ignoring paths that are unset or already gone.
+    """
+    if not path:
+        return
+    try:
+        await asyncio.to_thread(os.unlink, path)
+    except FileNotFoundError:
+        pass
 
 async def http_get_json(url: str, session: aiohttp.ClientSession, params: Optional[Dict] = None) -> Optional[Dict]:
     """
@@ -1699,48 +2098,54 @@ async def gif_command_handler(client: Client, message: Message):
 async def sticker_command_handler(client: Client, message: Message):
     """
     Handles the .sticker command to convert a replied photo into a Telegram sticker.
-    Telegram sticker sets require a special process; this command will simply convert
-    an image to a .webp format, which Telegram accepts as a sticker.
     """
     logger.info(f"Command {COMMAND_PREFIX}sticker executed by user {message.from_user.id}.")
+    await convert_to_sticker(client, message)
+
+async def convert_to_sticker(client: Client, message: Message):
+    """
+    Converts the replied photo into a sticker; shared by .sticker and .tosticker.
+    Telegram sticker sets require a special process; this will simply convert
+    an image to a .webp format, which Telegram accepts as a sticker.
+    """
     if not message.reply_to_message or not message.reply_to_message.photo:
         await message.edit(f"`Please reply to a photo to convert it into a sticker.`")
         return
 
-    await message.edit("`Converting photo to sticker... ✨`")
     try:
-        photo = message.reply_to_message.photo
-        # Download the photo
-        photo_path = await client.download_media(photo)
+        async with deferred_progress(message, "`Converting photo to sticker... ✨`"):
+            photo = message.reply_to_message.photo
+            # Download the photo
+            photo_path = await client.download_media(photo)
         
-        with Image.open(photo_path) as img:
-            # Resize image for sticker (512x512, with one side exactly 512px)
-            if img.width > img.height:
-                new_width = 512
-                new_height = int(img.height * (new_width / img.width))
-            else:
-                new_height = 512
-                new_width = int(img.width * (new_height / img.height))
+            with Image.open(photo_path) as img:
+                # Resize image for sticker (512x512, with one side exactly 512px)
+                if img.width > img.height:
+                    new_width = 512
+                    new_height = int(img.height * (new_width / img.width))
+                else:
+                    new_height = 512
+                    new_width = int(img.width * (new_height / img.height))
             
-            img = img.resize((new_width, new_height), Image.LANCZOS)
+                img = img.resize((new_width, new_height), Image.LANCZOS)
             
-            # Stickers usually have transparent backgrounds, but PIL converts to white by default
-            # For simplicity, we'll just convert to WEBP
+                # Stickers usually have transparent backgrounds, but PIL converts to white by default
+                # For simplicity, we'll just convert to WEBP
             
-            # Save to in-memory bytes as WEBP
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='WEBP')
-            img_byte_arr.seek(0)
+                # Save to in-memory bytes as WEBP
+                img_byte_arr = io.BytesIO()
+                img.save(img_byte_arr, format='WEBP')
+                img_byte_arr.seek(0)
             
-            await client.send_sticker(
-                chat_id=message.chat.id,
-                sticker=img_byte_arr
-            )
-            await message.delete()
-            logger.info(f"Photo converted to sticker and sent.")
+                await client.send_sticker(
+                    chat_id=message.chat.id,
+                    sticker=img_byte_arr
+                )
+                await message.delete()
+                logger.info(f"Photo converted to sticker and sent.")
         
-        # Clean up downloaded file
-        os.remove(photo_path)
+            # Clean up downloaded file
+            os.remove(photo_path)
     except Exception as e:
         logger.error(f"Error in sticker command: {e}", exc_info=True)
         await message.edit(f"Error converting to sticker: `{e}`")
@@ -2235,31 +2640,32 @@ async def time_command_handler(client: Client, message: Message):
         return
     
     await message.edit(f"`Fetching time for '{location}'... ⏳`")
-    async with aiohttp.ClientSession() as session:
-        # WorldTimeAPI supports /area/location (e.g., /Europe/London)
-        # or /timezone (e.g., /Asia/Tehran)
-        # We try to guess the format, or use a general search.
+    try:
+        async with aiohttp.ClientSession() as session:
+            # WorldTimeAPI supports /area/location (e.g., /Europe/London)
+            # or /timezone (e.g., /Asia/Tehran)
+            # We try to guess the format, or use a general search.
         
-        # Simple attempt with common format or direct
-        api_url = f"http://worldtimeapi.org/api/timezone/{requests.utils.quote(location)}"
-        json_data = await http_get_json(api_url, session)
+            # Simple attempt with common format or direct
+            api_url = f"http://worldtimeapi.org/api/timezone/{requests.utils.quote(location)}"
+            json_data = await http_get_json(api_url, session)
 
-        if json_data:
-            current_datetime_str = json_data.get('datetime')
-            timezone = json_data.get('timezone')
+            if json_data:
+                current_datetime_str = json_data.get('datetime')
+                timezone = json_data.get('timezone')
             
-            if current_datetime_str and timezone:
-                current_time = datetime.fromisoformat(current_datetime_str.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-                response_text = (
-                    f"**⏰ Current Time in {timezone}:**\n"
-                    f"▪️ **Date & Time:** `{current_time}`"
-                )
-                await message.edit(response_text)
-                logger.info(f"Time retrieved for '{location}'.")
-                return
+                if current_datetime_str and timezone:
+                    current_time = datetime.fromisoformat(current_datetime_str.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
+                    response_text = (
+                        f"**⏰ Current Time in {timezone}:**\n"
+                        f"▪️ **Date & Time:** `{current_time}`"
+                    )
+                    await message.edit(response_text)
+                    logger.info(f"Time retrieved for '{location}'.")
+                    return
         
-        await message.edit(f"`Could not find time for '{location}'. Please check city/timezone spelling (e.g., Europe/London).`")
-        logger.warning(f"Time API failed for '{location}'.")
+            await message.edit(f"`Could not find time for '{location}'. Please check city/timezone spelling (e.g., Europe/London).`")
+            logger.warning(f"Time API failed for '{location}'.")
     except Exception as e:
         logger.error(f"Error in time command: {e}", exc_info=True)
         await message.edit(f"Error fetching time: `{e}`")
@@ -2397,7 +2803,7 @@ async def remind_command_handler(client: Client, message: Message):
         await message.edit(f"`Invalid duration format. Use: 1h30m, 2d, 15m, 30s.`")
         return
     
-    remind_time = datetime.utcnow() + duration
+    remind_time = utc_now() + duration
 
     try:
         with Session(engine) as session:
@@ -2407,11 +2813,13 @@ async def remind_command_handler(client: Client, message: Message):
                 message_id=message.id, # The command message itself
                 remind_time=remind_time,
                 text=reminder_text,
+                rendered_text=render_reminder_text(reminder_text),
                 is_active=True
             )
             session.add(new_reminder)
             session.commit()
             session.refresh(new_reminder)
+        due_wakeup.set() # Let due_dispatcher re-plan around the new deadline
 
         await message.edit(f"**Reminder set!** I will remind you in approximately `{format_time_difference(duration.total_seconds())}` about: `{reminder_text}`")
         logger.info(f"Reminder set for {message.from_user.id} in chat {message.chat.id}.")
@@ -2567,7 +2975,7 @@ async def ban_command_handler(client: Client, message: Message):
     Handles the .ban command to ban a user from a group.
     Supports optional duration and reason.
     """
-    logger.info(f"Command {COMMAND_PREFIX}ban executed by user {message.from_user.id}.")
+    logger.info("Command %sban executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2598,7 +3006,7 @@ async def ban_command_handler(client: Client, message: Message):
     if duration_str:
         duration = await parse_time_duration(duration_str)
         if duration:
-            until_date = datetime.utcnow() + duration
+            until_date = utc_now() + duration
         else:
             await message.edit("`Invalid duration format. Banning permanently.`")
             # Continue with permanent ban
@@ -2615,15 +3023,15 @@ async def ban_command_handler(client: Client, message: Message):
             f"**Reason:** `{reason}`"
         )
         await message.edit(response_text)
-        logger.info(f"User {target_user_id} banned in chat {message.chat.id}. Duration: {time_info}, Reason: {reason}.")
+        logger.info("User %s banned in chat %s. Duration: %s, Reason: %s.", target_user_id, message.chat.id, time_info, reason)
     except UserAdminInvalid:
         await message.edit("`I cannot ban this user (they might be an admin or I lack sufficient privileges).`")
-        logger.warning(f"Cannot ban {target_user_id} in {message.chat.id} due to insufficient privileges or target is admin.")
+        logger.warning("Cannot ban %s in %s due to insufficient privileges or target is admin.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during ban: {e}`")
-        logger.error(f"BadRequest in ban command: {e}", exc_info=True)
+        logger.exception("BadRequest in ban command: %s", e)
     except Exception as e:
-        logger.error(f"Error in ban command: {e}", exc_info=True)
+        logger.exception("Error in ban command: %s", e)
         await message.edit(f"Error banning user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2635,7 +3043,7 @@ async def unban_command_handler(client: Client, message: Message):
     """
     Handles the .unban command to unban a user from a group.
     """
-    logger.info(f"Command {COMMAND_PREFIX}unban executed by user {message.from_user.id}.")
+    logger.info("Command %sunban executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2645,15 +3053,15 @@ async def unban_command_handler(client: Client, message: Message):
         await client.unban_chat_member(chat_id=message.chat.id, user_id=target_user_id)
         response_text = f"**User with ID `{target_user_id}` successfully unbanned.**"
         await message.edit(response_text)
-        logger.info(f"User {target_user_id} unbanned in chat {message.chat.id}.")
+        logger.info("User %s unbanned in chat %s.", target_user_id, message.chat.id)
     except UserAdminInvalid:
         await message.edit("`I cannot unban this user (they might be an admin).`")
-        logger.warning(f"Cannot unban {target_user_id} in {message.chat.id} due to insufficient privileges or target is admin.")
+        logger.warning("Cannot unban %s in %s due to insufficient privileges or target is admin.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during unban: {e}`")
-        logger.error(f"BadRequest in unban command: {e}", exc_info=True)
+        logger.exception("BadRequest in unban command: %s", e)
     except Exception as e:
-        logger.error(f"Error in unban command: {e}", exc_info=True)
+        logger.exception("Error in unban command: %s", e)
         await message.edit(f"Error unbanning user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2666,7 +3074,7 @@ async def kick_command_handler(client: Client, message: Message):
     Handles the .kick command to kick a user from a group.
     Note: Kicking is essentially a temporary ban, allowing the user to rejoin later.
     """
-    logger.info(f"Command {COMMAND_PREFIX}kick executed by user {message.from_user.id}.")
+    logger.info("Command %skick executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2679,17 +3087,17 @@ async def kick_command_handler(client: Client, message: Message):
     try:
         # Kicking means banning for a very short period (1 second) and then unbanning immediately.
         # This allows the user to rejoin.
-        await client.ban_chat_member(chat_id=message.chat.id, user_id=target_user_id, until_date=datetime.utcnow() + timedelta(seconds=1))
+        await client.ban_chat_member(chat_id=message.chat.id, user_id=target_user_id, until_date=utc_now() + timedelta(seconds=1))
         await message.edit(f"**User with ID `{target_user_id}` successfully kicked.**")
-        logger.info(f"User {target_user_id} kicked from chat {message.chat.id}.")
+        logger.info("User %s kicked from chat %s.", target_user_id, message.chat.id)
     except UserAdminInvalid:
         await message.edit("`I cannot kick this user (they might be an admin or I lack sufficient privileges).`")
-        logger.warning(f"Cannot kick {target_user_id} in {message.chat.id} due to insufficient privileges or target is admin.")
+        logger.warning("Cannot kick %s in %s due to insufficient privileges or target is admin.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during kick: {e}`")
-        logger.error(f"BadRequest in kick command: {e}", exc_info=True)
+        logger.exception("BadRequest in kick command: %s", e)
     except Exception as e:
-        logger.error(f"Error in kick command: {e}", exc_info=True)
+        logger.exception("Error in kick command: %s", e)
         await message.edit(f"Error kicking user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2702,7 +3110,7 @@ async def mute_command_handler(client: Client, message: Message):
     Handles the .mute command to restrict a user's permissions in a group.
     Supports optional duration and reason.
     """
-    logger.info(f"Command {COMMAND_PREFIX}mute executed by user {message.from_user.id}.")
+    logger.info("Command %smute executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2731,7 +3139,7 @@ async def mute_command_handler(client: Client, message: Message):
     if duration_str:
         duration = await parse_time_duration(duration_str)
         if duration:
-            until_date = datetime.utcnow() + duration
+            until_date = utc_now() + duration
         else:
             await message.edit("`Invalid duration format. Muting permanently.`")
             # Continue with permanent mute
@@ -2750,15 +3158,15 @@ async def mute_command_handler(client: Client, message: Message):
             f"**Reason:** `{reason}`"
         )
         await message.edit(response_text)
-        logger.info(f"User {target_user_id} muted in chat {message.chat.id}. Duration: {time_info}, Reason: {reason}.")
+        logger.info("User %s muted in chat %s. Duration: %s, Reason: %s.", target_user_id, message.chat.id, time_info, reason)
     except UserAdminInvalid:
         await message.edit("`I cannot mute this user (they might be an admin or I lack sufficient privileges).`")
-        logger.warning(f"Cannot mute {target_user_id} in {message.chat.id} due to insufficient privileges or target is admin.")
+        logger.warning("Cannot mute %s in %s due to insufficient privileges or target is admin.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during mute: {e}`")
-        logger.error(f"BadRequest in mute command: {e}", exc_info=True)
+        logger.exception("BadRequest in mute command: %s", e)
     except Exception as e:
-        logger.error(f"Error in mute command: {e}", exc_info=True)
+        logger.exception("Error in mute command: %s", e)
         await message.edit(f"Error muting user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2770,7 +3178,7 @@ async def unmute_command_handler(client: Client, message: Message):
     """
     Handles the .unmute command to restore a user's permissions in a group.
     """
-    logger.info(f"Command {COMMAND_PREFIX}unmute executed by user {message.from_user.id}.")
+    logger.info("Command %sunmute executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2797,15 +3205,15 @@ async def unmute_command_handler(client: Client, message: Message):
             )
         )
         await message.edit(f"**User with ID `{target_user_id}` successfully unmuted.**")
-        logger.info(f"User {target_user_id} unmuted in chat {message.chat.id}.")
+        logger.info("User %s unmuted in chat %s.", target_user_id, message.chat.id)
     except UserAdminInvalid:
         await message.edit("`I cannot unmute this user (they might be an admin or I lack sufficient privileges).`")
-        logger.warning(f"Cannot unmute {target_user_id} in {message.chat.id} due to insufficient privileges or target is admin.")
+        logger.warning("Cannot unmute %s in %s due to insufficient privileges or target is admin.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during unmute: {e}`")
-        logger.error(f"BadRequest in unmute command: {e}", exc_info=True)
+        logger.exception("BadRequest in unmute command: %s", e)
     except Exception as e:
-        logger.error(f"Error in unmute command: {e}", exc_info=True)
+        logger.exception("Error in unmute command: %s", e)
         await message.edit(f"Error unmuting user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2819,7 +3227,7 @@ async def promote_command_handler(client: Client, message: Message):
     Usage: .promote [reply/user_id] [permission1] [permission2] ...
     Example: .promote @user can_delete_messages can_pin_messages
     """
-    logger.info(f"Command {COMMAND_PREFIX}promote executed by user {message.from_user.id}.")
+    logger.info("Command %spromote executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2883,15 +3291,15 @@ async def promote_command_handler(client: Client, message: Message):
             is_anonymous=is_anonymous
         )
         await message.edit(f"**User with ID `{target_user_id}` promoted with {permissions_text}.**")
-        logger.info(f"User {target_user_id} promoted in chat {message.chat.id} with rights: {permissions_text}.")
+        logger.info("User %s promoted in chat %s with rights: %s.", target_user_id, message.chat.id, permissions_text)
     except UserAdminInvalid:
         await message.edit("`I cannot promote this user (they might already be an admin with higher rights, or I lack sufficient privileges).`")
-        logger.warning(f"Cannot promote {target_user_id} in {message.chat.id} due to insufficient privileges or target admin status.")
+        logger.warning("Cannot promote %s in %s due to insufficient privileges or target admin status.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during promote: {e}`")
-        logger.error(f"BadRequest in promote command: {e}", exc_info=True)
+        logger.exception("BadRequest in promote command: %s", e)
     except Exception as e:
-        logger.error(f"Error in promote command: {e}", exc_info=True)
+        logger.exception("Error in promote command: %s", e)
         await message.edit(f"Error promoting user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2903,7 +3311,7 @@ async def demote_command_handler(client: Client, message: Message):
     """
     Handles the .demote command to demote an administrator back to a regular member.
     """
-    logger.info(f"Command {COMMAND_PREFIX}demote executed by user {message.from_user.id}.")
+    logger.info("Command %sdemote executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -2929,15 +3337,15 @@ async def demote_command_handler(client: Client, message: Message):
             is_anonymous=False
         )
         await message.edit(f"**User with ID `{target_user_id}` successfully demoted.**")
-        logger.info(f"User {target_user_id} demoted in chat {message.chat.id}.")
+        logger.info("User %s demoted in chat %s.", target_user_id, message.chat.id)
     except UserAdminInvalid:
         await message.edit("`I cannot demote this user (they might be an owner or have higher rights than me).`")
-        logger.warning(f"Cannot demote {target_user_id} in {message.chat.id} due to insufficient privileges or target is owner.")
+        logger.warning("Cannot demote %s in %s due to insufficient privileges or target is owner.", target_user_id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during demote: {e}`")
-        logger.error(f"BadRequest in demote command: {e}", exc_info=True)
+        logger.exception("BadRequest in demote command: %s", e)
     except Exception as e:
-        logger.error(f"Error in demote command: {e}", exc_info=True)
+        logger.exception("Error in demote command: %s", e)
         await message.edit(f"Error demoting user: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2949,7 +3357,7 @@ async def pin_command_handler(client: Client, message: Message):
     """
     Handles the .pin command to pin a replied message in a group.
     """
-    logger.info(f"Command {COMMAND_PREFIX}pin executed by user {message.from_user.id}.")
+    logger.info("Command %spin executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     if not message.reply_to_message:
         await message.edit("`Please reply to a message to pin it.`")
         return
@@ -2961,12 +3369,12 @@ async def pin_command_handler(client: Client, message: Message):
             disable_notification=False # Set to True to pin silently
         )
         await message.edit(f"**Message `{message.reply_to_message.id}` successfully pinned.**")
-        logger.info(f"Message {message.reply_to_message.id} pinned in chat {message.chat.id}.")
+        logger.info("Message %s pinned in chat %s.", message.reply_to_message.id, message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during pin: {e}`")
-        logger.error(f"BadRequest in pin command: {e}", exc_info=True)
+        logger.exception("BadRequest in pin command: %s", e)
     except Exception as e:
-        logger.error(f"Error in pin command: {e}", exc_info=True)
+        logger.exception("Error in pin command: %s", e)
         await message.edit(f"Error pinning message: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -2979,7 +3387,7 @@ async def unpin_command_handler(client: Client, message: Message):
     Handles the .unpin command to unpin a replied message or all pinned messages.
     Usage: .unpin (replied to a message) or .unpin all
     """
-    logger.info(f"Command {COMMAND_PREFIX}unpin executed by user {message.from_user.id}.")
+    logger.info("Command %sunpin executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     arg = await extract_arg(message)
 
     try:
@@ -2989,22 +3397,22 @@ async def unpin_command_handler(client: Client, message: Message):
                 message_id=message.reply_to_message.id
             )
             await message.edit(f"**Message `{message.reply_to_message.id}` successfully unpinned.**")
-            logger.info(f"Message {message.reply_to_message.id} unpinned in chat {message.chat.id}.")
+            logger.info("Message %s unpinned in chat %s.", message.reply_to_message.id, message.chat.id)
         elif arg and arg.lower() == "all":
             await client.unpin_all_chat_messages(chat_id=message.chat.id)
             await message.edit(f"**All pinned messages successfully unpinned.**")
-            logger.info(f"All pinned messages unpinned in chat {message.chat.id}.")
+            logger.info("All pinned messages unpinned in chat %s.", message.chat.id)
         else:
             await message.edit("`Please reply to a message to unpin it, or use '.unpin all' to unpin all messages.`")
             return
     except MessageIdInvalid:
         await message.edit("`The replied message is not pinned.`")
-        logger.warning(f"Tried to unpin non-pinned message {message.reply_to_message.id}.")
+        logger.warning("Tried to unpin non-pinned message %s.", message.reply_to_message.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during unpin: {e}`")
-        logger.error(f"BadRequest in unpin command: {e}", exc_info=True)
+        logger.exception("BadRequest in unpin command: %s", e)
     except Exception as e:
-        logger.error(f"Error in unpin command: {e}", exc_info=True)
+        logger.exception("Error in unpin command: %s", e)
         await message.edit(f"Error unpinning message(s): `{e}`")
 
 # -------------------------------------------------------------------------
@@ -3016,7 +3424,7 @@ async def del_command_handler(client: Client, message: Message):
     """
     Handles the .del command to delete a replied message (not the command itself).
     """
-    logger.info(f"Command {COMMAND_PREFIX}del executed by user {message.from_user.id}.")
+    logger.info("Command %sdel executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     if not message.reply_to_message:
         await message.edit("`Please reply to a message to delete it.`")
         return
@@ -3027,12 +3435,12 @@ async def del_command_handler(client: Client, message: Message):
             chat_id=message.chat.id,
             message_ids=[message.id, message.reply_to_message.id]
         )
-        logger.info(f"Message {message.reply_to_message.id} deleted by user {message.from_user.id}.")
+        logger.info("Message %s deleted by user %s.", message.reply_to_message.id, message.from_user.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error during deletion: {e}`")
-        logger.error(f"BadRequest in del command: {e}", exc_info=True)
+        logger.exception("BadRequest in del command: %s", e)
     except Exception as e:
-        logger.error(f"Error in del command: {e}", exc_info=True)
+        logger.exception("Error in del command: %s", e)
         await message.edit(f"Error deleting message: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -3044,7 +3452,7 @@ async def setgtitle_command_handler(client: Client, message: Message):
     """
     Handles the .setgtitle command to change the group's title.
     """
-    logger.info(f"Command {COMMAND_PREFIX}setgtitle executed by user {message.from_user.id}.")
+    logger.info("Command %ssetgtitle executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     new_title = await extract_arg(message)
     if not new_title:
         await message.edit("`Please provide a new title for the group!`")
@@ -3053,12 +3461,12 @@ async def setgtitle_command_handler(client: Client, message: Message):
     try:
         await client.set_chat_title(chat_id=message.chat.id, title=new_title)
         await message.edit(f"**Group title successfully changed to:** `{new_title}`")
-        logger.info(f"Group title of {message.chat.id} changed to '{new_title}'.")
+        logger.info("Group title of %s changed to '%s'.", message.chat.id, new_title)
     except BadRequest as e:
         await message.edit(f"`Bad request error changing title: {e}`")
-        logger.error(f"BadRequest in setgtitle command: {e}", exc_info=True)
+        logger.exception("BadRequest in setgtitle command: %s", e)
     except Exception as e:
-        logger.error(f"Error in setgtitle command: {e}", exc_info=True)
+        logger.exception("Error in setgtitle command: %s", e)
         await message.edit(f"Error setting group title: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -3070,7 +3478,7 @@ async def setgdesc_command_handler(client: Client, message: Message):
     """
     Handles the .setgdesc command to change the group's description.
     """
-    logger.info(f"Command {COMMAND_PREFIX}setgdesc executed by user {message.from_user.id}.")
+    logger.info("Command %ssetgdesc executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     new_description = await extract_arg(message)
     if new_description is None: # Allow empty string to clear description
         await message.edit("`Please provide a new description for the group, or use an empty string to clear it.`")
@@ -3079,12 +3487,12 @@ async def setgdesc_command_handler(client: Client, message: Message):
     try:
         await client.set_chat_description(chat_id=message.chat.id, description=new_description)
         await message.edit(f"**Group description successfully changed to:** ```\n{new_description or 'Cleared'}```")
-        logger.info(f"Group description of {message.chat.id} changed.")
+        logger.info("Group description of %s changed.", message.chat.id)
     except BadRequest as e:
         await message.edit(f"`Bad request error changing description: {e}`")
-        logger.error(f"BadRequest in setgdesc command: {e}", exc_info=True)
+        logger.exception("BadRequest in setgdesc command: %s", e)
     except Exception as e:
-        logger.error(f"Error in setgdesc command: {e}", exc_info=True)
+        logger.exception("Error in setgdesc command: %s", e)
         await message.edit(f"Error setting group description: `{e}`")
 
 # -------------------------------------------------------------------------
@@ -3097,7 +3505,7 @@ async def warn_command_handler(client: Client, message: Message):
     Handles the .warn command to issue a warning to a user.
     Warnings are stored persistently in the database.
     """
-    logger.info(f"Command {COMMAND_PREFIX}warn executed by user {message.from_user.id}.")
+    logger.info("Command %swarn executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -3117,6 +3525,8 @@ async def warn_command_handler(client: Client, message: Message):
                 user_id=target_user_id,
                 chat_id=message.chat.id,
                 admin_id=message.from_user.id,
+                admin_first_name=message.from_user.first_name,
+                admin_username=message.from_user.username,
                 reason=reason
             )
             session.add(new_warning)
@@ -3136,9 +3546,9 @@ async def warn_command_handler(client: Client, message: Message):
                 f"**Reason:** `{reason}`\n"
                 f"**Total Warnings:** `{len(user_warnings)}`"
             )
-            logger.info(f"User {target_user_id} warned in chat {message.chat.id}. Total warnings: {len(user_warnings)}.")
+            logger.info("User %s warned in chat %s. Total warnings: %s.", target_user_id, message.chat.id, len(user_warnings))
     except Exception as e:
-        logger.error(f"Error in warn command: {e}", exc_info=True)
+        logger.exception("Error in warn command: %s", e)
         await message.edit(f"Error warning user: `{e}`")
 
 @app.on_message(filters.me & filters.command("unwarn", prefixes=COMMAND_PREFIX))
@@ -3147,7 +3557,7 @@ async def unwarn_command_handler(client: Client, message: Message):
     """
     Handles the .unwarn command to remove the most recent warning from a user.
     """
-    logger.info(f"Command {COMMAND_PREFIX}unwarn executed by user {message.from_user.id}.")
+    logger.info("Command %sunwarn executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     target_user_id = await get_target_user_id(message)
     if not target_user_id:
         await message.edit("`Please reply to a user, or provide their ID/username.`")
@@ -3174,12 +3584,12 @@ async def unwarn_command_handler(client: Client, message: Message):
                     f"**One warning removed for {user_mention}!**\n"
                     f"**Remaining Warnings:** `{remaining_warnings}`"
                 )
-                logger.info(f"One warning removed for user {target_user_id} in chat {message.chat.id}. Remaining: {remaining_warnings}.")
+                logger.info("One warning removed for user %s in chat %s. Remaining: %s.", target_user_id, message.chat.id, remaining_warnings)
             else:
                 await message.edit(f"`User has no warnings in this chat.`")
-                logger.warning(f"No warnings found for user {target_user_id} to unwarn.")
+                logger.warning("No warnings found for user %s to unwarn.", target_user_id)
     except Exception as e:
-        logger.error(f"Error in unwarn command: {e}", exc_info=True)
+        logger.exception("Error in unwarn command: %s", e)
         await message.edit(f"Error removing warning: `{e}`")
 
 @app.on_message(filters.me & filters.command("warnings", prefixes=COMMAND_PREFIX))
@@ -3194,39 +3604,49 @@ async def list_warnings_command_handler(client: Client, message: Message):
         return
 
     try:
-        with Session(engine) as session:
-            warnings = session.exec(
+        async with async_session() as session:
+            warnings = (await session.exec(
                 select(Warning).where(Warning.user_id == target_user_id, Warning.chat_id == message.chat.id)
                 .order_by(Warning.timestamp.asc()) # Show oldest first
-            ).all()
+            )).all()
 
             user_info = await client.get_users(target_user_id)
             user_mention = f"[{user_info.first_name}](tg://user?id={user_info.id})"
 
             if warnings:
-                response_text = f"**⚠️ Warnings for {user_mention} ({len(warnings)} total):**\n\n"
+                # Admin names are stored on the row; only legacy rows without one need a (batched, cached) lookup
+                legacy_admin_ids = [warn.admin_id for warn in warnings if not warn.admin_first_name]
+                admins = await get_users_cached(client, legacy_admin_ids) if legacy_admin_ids else {}
+                parts = [f"**⚠️ Warnings for {user_mention} ({len(warnings)} total):**\n\n"]
                 for i, warn in enumerate(warnings):
-                    admin_info = await client.get_users(warn.admin_id)
-                    admin_mention = f"[{admin_info.first_name}](tg://user?id={admin_info.id})"
-                    response_text += (
+                    admin_name = warn.admin_first_name
+                    if not admin_name:
+                        admin_info = admins.get(warn.admin_id)
+                        admin_name = admin_info.first_name if admin_info else warn.admin_id
+                    admin_mention = f"[{admin_name}](tg://user?id={warn.admin_id})"
+                    parts.append(
                         f"**{i+1}.** `Date: {warn.timestamp.strftime('%Y-%m-%d %H:%M')}`\n"
                         f"   `Reason: {warn.reason}`\n"
                         f"   `Admin: {admin_mention}`\n\n"
                     )
                 
                 # Check message length before sending
-                if len(response_text) > 4096:
-                    # If too long, send as a document
-                    with io.BytesIO(response_text.encode('utf-8')) as f:
-                        f.name = "warnings.txt"
+                if sum(map(len, parts)) > 4096:
+                    # If too long, stream the fragments to a temp file and send it as a document,
+                    # so the full text and its UTF-8 copy are never held in memory together
+                    async with aiofiles.tempfile.NamedTemporaryFile("w+b", suffix=".txt") as f:
+                        for part in parts:
+                            await f.write(part.encode('utf-8'))
+                        await f.flush()
                         await client.send_document(
                             chat_id=message.chat.id,
-                            document=f,
+                            document=f.name,
+                            file_name="warnings.txt",
                             caption=f"**Warnings for {user_mention}**"
                         )
                     await message.delete()
                 else:
-                    await message.edit(response_text)
+                    await message.edit("".join(parts)) # Linear, unlike repeated += on a growing string
                 logger.info(f"Listed {len(warnings)} warnings for user {target_user_id}.")
             else:
                 await message.edit(f"**{user_mention} has no warnings in this chat.**")
@@ -3241,6 +3661,43 @@ async def list_warnings_command_handler(client: Client, message: Message):
 # They are generally NOT recommended for public userbots and should be used
 # with extreme caution by the userbot owner only.
 # -------------------------------------------------------------------------
+GBAN_FANOUT_WORKERS: int = 10 # Concurrent ban/unban workers during .gban/.ungban
+GBAN_CHAT_TYPES = frozenset({ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL}) # Chats a global ban fans out to
+
+async def gban_fanout(client: Client, target_user_id: int, exclude_chat_id: int, unban: bool = False) -> None:
+    """
+    Bans (or unbans) a user in every group/channel the userbot is in.
+    A producer pages through the dialogs while GBAN_FANOUT_WORKERS workers
+    drain the chat queue, so dialog pagination overlaps with the ban requests.
+    """
+    label, verb = ("UnGBan", "Unbanned") if unban else ("GBan", "Kicked")
+    action = with_tg_backoff(client.unban_chat_member if unban else client.ban_chat_member, idempotent=True)
+    chat_queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    async def producer() -> None:
+        try:
+            async for dialog in client.get_dialogs():
+                if dialog.chat.type in GBAN_CHAT_TYPES and dialog.chat.id != exclude_chat_id:
+                    await chat_queue.put(dialog.chat.id)
+        finally:
+            for _ in range(GBAN_FANOUT_WORKERS):
+                await chat_queue.put(None) # One stop signal per worker
+
+    async def worker() -> None:
+        while (chat_id := await chat_queue.get()) is not None:
+            try:
+                # Check if userbot has ban rights in this chat
+                if await check_userbot_rights_in_chat(chat_id, ['can_restrict_members']):
+                    async with tg_write_limiter:
+                        await action(chat_id, target_user_id)
+                    logger.info("%s: %s %s in %s.", label, verb, target_user_id, chat_id)
+                else:
+                    logger.warning("%s: No restrict rights in %s for %s.", label, chat_id, target_user_id)
+            except Exception as e:
+                logger.error("%s: Error processing %s in %s: %s", label, target_user_id, chat_id, e)
+
+    await asyncio.gather(producer(), *(worker() for _ in range(GBAN_FANOUT_WORKERS)))
+
 @app.on_message(filters.me & filters.command("gban", prefixes=COMMAND_PREFIX))
 async def gban_command_handler(client: Client, message: Message):
     """
@@ -3263,39 +3720,18 @@ async def gban_command_handler(client: Client, message: Message):
         reason = "Globally banned by userbot owner."
 
     try:
-        with Session(engine) as session:
-            # Store gban status in UserSetting
-            existing_gban = session.exec(
-                select(UserSetting).where(UserSetting.user_id == target_user_id, UserSetting.key == "gban_status")
-            ).first()
-
-            if existing_gban:
-                existing_gban.value = reason
-                session.add(existing_gban)
-                response = f"**User `{target_user_id}`'s global ban reason updated to:** `{reason}`"
-            else:
-                new_gban = UserSetting(user_id=target_user_id, key="gban_status", value=reason)
-                session.add(new_gban)
-                response = f"**User `{target_user_id}` globally banned.**\n**Reason:** `{reason}`"
-            
-            session.commit()
+        async with async_session() as session:
+            # Store gban status in UserSetting (re-running .gban just updates the reason)
+            await upsert_setting(session, UserSetting, "user_id", target_user_id, "gban_status", reason)
+            await session.commit()
+            response = f"**User `{target_user_id}` globally banned.**\n**Reason:** `{reason}`"
+            gban_cache[target_user_id] = reason
             await message.edit(response + "\n`Userbot will attempt to restrict/kick this user in all joined chats.`")
             logger.critical(f"User {target_user_id} globally banned by userbot. Reason: {reason}.")
             
             # Optionally, iterate through all chats and ban/kick (this could take a very long time for many chats)
             await message.reply("`Attempting to kick/ban user from all accessible chats...`")
-            async for dialog in client.get_dialogs():
-                if dialog.chat.type in ["group", "supergroup", "channel"] and dialog.chat.id != message.chat.id:
-                    try:
-                        # Check if userbot has ban rights in this chat
-                        if await check_userbot_rights_in_chat(dialog.chat.id, ['can_restrict_members']):
-                            await client.ban_chat_member(dialog.chat.id, target_user_id)
-                            logger.info(f"GBan: Kicked {target_user_id} from {dialog.chat.id}.")
-                        else:
-                            logger.warning(f"GBan: No restrict rights in {dialog.chat.id} for {target_user_id}.")
-                    except Exception as e:
-                        logger.error(f"GBan: Error processing {target_user_id} in {dialog.chat.id}: {e}")
-                await asyncio.sleep(0.1) # Small delay to avoid flood waits
+            await gban_fanout(client, target_user_id, exclude_chat_id=message.chat.id)
             await message.reply("`Global ban processing complete (or attempted) across all chats.`")
 
     except Exception as e:
@@ -3314,29 +3750,20 @@ async def ungban_command_handler(client: Client, message: Message):
         return
 
     try:
-        with Session(engine) as session:
-            gban_setting = session.exec(
+        async with async_session() as session:
+            gban_setting = (await session.exec(
                 select(UserSetting).where(UserSetting.user_id == target_user_id, UserSetting.key == "gban_status")
-            ).first()
+            )).first()
 
             if gban_setting:
-                session.delete(gban_setting)
-                session.commit()
+                await session.delete(gban_setting)
+                await session.commit()
+                gban_cache[target_user_id] = None
                 await message.edit(f"**User `{target_user_id}` globally unbanned.**")
                 logger.critical(f"User {target_user_id} globally unbanned by userbot.")
                 # Optionally, iterate through chats and unban (can take long)
                 await message.reply("`Attempting to unban user from all accessible chats...`")
-                async for dialog in client.get_dialogs():
-                    if dialog.chat.type in ["group", "supergroup", "channel"] and dialog.chat.id != message.chat.id:
-                        try:
-                            if await check_userbot_rights_in_chat(dialog.chat.id, ['can_restrict_members']):
-                                await client.unban_chat_member(dialog.chat.id, target_user_id)
-                                logger.info(f"UnGBan: Unbanned {target_user_id} from {dialog.chat.id}.")
-                            else:
-                                logger.warning(f"UnGBan: No restrict rights in {dialog.chat.id} for {target_user_id}.")
-                        except Exception as e:
-                            logger.error(f"UnGBan: Error processing {target_user_id} in {dialog.chat.id}: {e}")
-                    await asyncio.sleep(0.1)
+                await gban_fanout(client, target_user_id, exclude_chat_id=message.chat.id, unban=True)
                 await message.reply("`Global unban processing complete (or attempted) across all chats.`")
             else:
                 await message.edit(f"`User `{target_user_id}` is not globally banned.`")
@@ -3346,41 +3773,49 @@ async def ungban_command_handler(client: Client, message: Message):
         await message.edit(f"Error globally unbanning user: `{e}`")
 
 # -------------------------------------------------------------------------
-# Event handler to enforce global ban for new members
-# This should be placed at the end of event handlers.
+# Global ban enforcement for new members (called from new_chat_members_handler)
 # -------------------------------------------------------------------------
-@app.on_message(filters.new_chat_members)
-async def enforce_gban_on_new_members(client: Client, message: Message):
+async def enforce_gban_on_new_members(client: Client, message: Message, new_members: List[User], reasons: Dict[int, Optional[str]]):
     """
-    Automatically checks if new chat members are globally banned and acts accordingly.
+    Kicks new chat members that are globally banned, given their resolved gban reasons.
     """
-    for new_member in message.new_chat_members:
-        if new_member.id == client.me.id: # Ignore self joining
+    for new_member in new_members:
+        reason = reasons[new_member.id]
+        if reason is None:
             continue
-
-        with Session(engine) as session:
-            gban_setting = session.exec(
-                select(UserSetting).where(User_Setting.user_id == new_member.id, UserSetting.key == "gban_status")
-            ).first()
-
-            if gban_setting:
-                reason = gban_setting.value
-                try:
-                    if await check_userbot_rights_in_chat(message.chat.id, ['can_restrict_members']):
-                        await client.ban_chat_member(message.chat.id, new_member.id)
-                        await client.send_message(
-                            chat_id=message.chat.id,
-                            text=f"**User {new_member.mention} (ID: `{new_member.id}`) was globally banned by userbot owner. Kicked!**\n**Reason:** `{reason}`"
-                        )
-                        logger.info(f"GBan enforced: Kicked {new_member.id} from {message.chat.id}.")
-                    else:
-                        logger.warning(f"GBan: No restrict rights in {message.chat.id} to kick {new_member.id}.")
-                except Exception as e:
-                    logger.error(f"Error enforcing gban for {new_member.id} in {message.chat.id}: {e}")
+        try:
+            if await check_userbot_rights_in_chat(message.chat.id, ['can_restrict_members']):
+                await with_tg_backoff(client.ban_chat_member, idempotent=True)(message.chat.id, new_member.id)
+                await with_tg_backoff(client.send_message)(
+                    chat_id=message.chat.id,
+                    text=f"**User {new_member.mention} (ID: `{new_member.id}`) was globally banned by userbot owner. Kicked!**\n**Reason:** `{reason}`"
+                )
+                logger.info(f"GBan enforced: Kicked {new_member.id} from {message.chat.id}.")
+            else:
+                logger.warning(f"GBan: No restrict rights in {message.chat.id} to kick {new_member.id}.")
+        except Exception as e:
+            logger.error(f"Error enforcing gban for {new_member.id} in {message.chat.id}: {e}")
 
 # -------------------------------------------------------------------------
 # Commands: .setwelcome, .delwelcome - Customizable welcome messages.
 # -------------------------------------------------------------------------
+_WELCOME_PLACEHOLDER_RE = re.compile(r'\{(user|chat)\}')
+
+@lru_cache(maxsize=1024)
+def compile_welcome_template(template: str) -> tuple:
+    """
+    Splits a welcome template into ("lit", text) / ("var", name) tokens, parsed once per distinct template.
+    """
+    pieces = _WELCOME_PLACEHOLDER_RE.split(template)
+    # re.split with one capture group alternates literal text and placeholder names
+    return tuple(("var" if i % 2 else "lit", piece) for i, piece in enumerate(pieces) if piece)
+
+def render_welcome_template(template: str, ctx: Dict[str, str]) -> str:
+    """
+    Fills a welcome template's {user}/{chat} placeholders in a single join.
+    """
+    return "".join(ctx[value] if kind == "var" else value for kind, value in compile_welcome_template(template))
+
 @app.on_message(filters.me & filters.command("setwelcome", prefixes=COMMAND_PREFIX))
 @require_admin_rights(['can_restrict_members']) # Often, bots with welcome messages also have restrict rights
 async def set_welcome_message_handler(client: Client, message: Message):
@@ -3399,22 +3834,12 @@ async def set_welcome_message_handler(client: Client, message: Message):
         return
 
     try:
-        with Session(engine) as session:
-            chat_setting = session.exec(
-                select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "welcome_message")
-            ).first()
-
-            if chat_setting:
-                chat_setting.value = welcome_text
-                session.add(chat_setting)
-                response = f"**Welcome message updated for this chat!**"
-            else:
-                new_setting = ChatSetting(chat_id=message.chat.id, key="welcome_message", value=welcome_text)
-                session.add(new_setting)
-                response = f"**Welcome message set for this chat!**"
-            
-            session.commit()
-            await message.edit(response)
+        async with async_session() as session:
+            await upsert_setting(session, ChatSetting, "chat_id", message.chat.id, "welcome_message", welcome_text)
+            await session.commit()
+            chat_setting_cache[(message.chat.id, "welcome_message")] = welcome_text
+            compile_welcome_template(welcome_text) # Parse now so the first join doesn't pay for it
+            await message.edit(f"**Welcome message set for this chat!**")
             logger.info(f"Welcome message set/updated in chat {message.chat.id}.")
     except Exception as e:
         logger.error(f"Error setting welcome message: {e}", exc_info=True)
@@ -3432,14 +3857,15 @@ async def del_welcome_message_handler(client: Client, message: Message):
         return
 
     try:
-        with Session(engine) as session:
-            chat_setting = session.exec(
+        async with async_session() as session:
+            chat_setting = (await session.exec(
                 select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "welcome_message")
-            ).first()
+            )).first()
 
             if chat_setting:
-                session.delete(chat_setting)
-                session.commit()
+                await session.delete(chat_setting)
+                await session.commit()
+                chat_setting_cache[(message.chat.id, "welcome_message")] = None
                 await message.edit(f"**Welcome message deleted for this chat!**")
                 logger.info(f"Welcome message deleted in chat {message.chat.id}.")
             else:
@@ -3449,36 +3875,62 @@ async def del_welcome_message_handler(client: Client, message: Message):
         logger.error(f"Error deleting welcome message: {e}", exc_info=True)
         await message.edit(f"Error deleting welcome message: `{e}`")
 
-# Event handler for new chat members (to send welcome message)
+async def welcome_new_members(client: Client, message: Message, members: List[User], welcome_text: str):
+    """
+    Sends the chat's welcome message, greeting all members that joined in the same update at once.
+    """
+    # Fill placeholders from the pre-parsed template
+    mentions = ", ".join(m.mention for m in members)
+    welcome_text = render_welcome_template(welcome_text, {"user": mentions, "chat": message.chat.title or ""})
+    member_ids = [m.id for m in members]
+    try:
+        await with_tg_backoff(client.send_message)(
+            chat_id=message.chat.id,
+            text=welcome_text,
+            reply_to_message_id=message.id
+        )
+        logger.info("Sent welcome message to %s in %s.", member_ids, message.chat.id)
+    except Exception as e:
+        logger.error("Error sending welcome message to %s: %s", member_ids, e, exc_info=True)
+
+# Event handler for new chat members: gban enforcement and welcome message.
+# Pyrogram runs only the first matching handler per group, so both live in one handler.
 @app.on_message(filters.new_chat_members & filters.group)
-async def welcome_new_member_event_handler(client: Client, message: Message):
+async def new_chat_members_handler(client: Client, message: Message):
     """
-    Listens for new chat members and sends a custom welcome message if configured.
+    Handles join events: kicks globally banned members, then welcomes the rest if configured.
     """
-    for new_member in message.new_chat_members:
-        if new_member.id == client.me.id: # Ignore self joining
-            continue
-        
-        with Session(engine) as session:
-            chat_setting = session.exec(
-                select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "welcome_message")
-            ).first()
+    members = [m for m in message.new_chat_members if m.id != client.me.id] # Ignore self joining
+    if not members:
+        return
+    chat_id = message.chat.id
 
-            if chat_setting and chat_setting.value:
-                welcome_text = chat_setting.value
-                # Replace placeholders
-                welcome_text = welcome_text.replace("{user}", new_member.mention)
-                welcome_text = welcome_text.replace("{chat}", message.chat.title)
-                
-                try:
-                    await client.send_message(
-                        chat_id=message.chat.id,
-                        text=welcome_text,
-                        reply_to_message_id=message.id
-                    )
-                    logger.info(f"Sent welcome message to {new_member.id} in {message.chat.id}.")
-                except Exception as e:
-                    logger.error(f"Error sending welcome message to {new_member.id}: {e}", exc_info=True)
+    # Resolve gban status and the welcome text from the caches; any misses share one session
+    reasons: Dict[int, Optional[str]] = {m.id: gban_cache.get(m.id, _MISSING) for m in members}
+    missing_ids = [user_id for user_id, reason in reasons.items() if reason is _MISSING]
+    welcome_text = chat_setting_cache.get((chat_id, "welcome_message"), _MISSING)
+    if missing_ids or welcome_text is _MISSING:
+        async with async_session() as session:
+            # An AsyncSession must not run statements concurrently, so these are awaited in turn
+            if missing_ids:
+                gban_settings = (await session.exec(
+                    select(UserSetting).where(UserSetting.user_id.in_(missing_ids), UserSetting.key == "gban_status")
+                )).all()
+                found = {gban_setting.user_id: gban_setting.value for gban_setting in gban_settings}
+                for user_id in missing_ids:
+                    reasons[user_id] = gban_cache[user_id] = found.get(user_id)
+            if welcome_text is _MISSING:
+                chat_setting = (await session.exec(
+                    select(ChatSetting).where(ChatSetting.chat_id == chat_id, ChatSetting.key == "welcome_message")
+                )).first()
+                welcome_text = chat_setting_cache[(chat_id, "welcome_message")] = chat_setting.value if chat_setting else None
+
+    banned = [m for m in members if reasons[m.id] is not None]
+    if banned:
+        await enforce_gban_on_new_members(client, message, banned, reasons)
+    welcomed = [m for m in members if reasons[m.id] is None]
+    if welcome_text and welcomed:
+        await welcome_new_members(client, message, welcomed, welcome_text)
 
 # -------------------------------------------------------------------------
 # Commands: .antilink, .antiflood - Basic group protections.
@@ -3502,19 +3954,10 @@ async def antilink_command_handler(client: Client, message: Message):
 
     status = (arg == "on")
     try:
-        with Session(engine) as session:
-            chat_setting = session.exec(
-                select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "antilink_status")
-            ).first()
-
-            if chat_setting:
-                chat_setting.value = str(status)
-                session.add(chat_setting)
-            else:
-                new_setting = ChatSetting(chat_id=message.chat.id, key="antilink_status", value=str(status))
-                session.add(new_setting)
-            
-            session.commit()
+        async with async_session() as session:
+            await upsert_setting(session, ChatSetting, "chat_id", message.chat.id, "antilink_status", str(status))
+            await session.commit()
+            chat_setting_cache[(message.chat.id, "antilink_status")] = str(status)
             await message.edit(f"**Anti-link protection set to: `{arg.upper()}`**")
             logger.info(f"Anti-link set to {arg} in chat {message.chat.id}.")
     except Exception as e:
@@ -3522,90 +3965,158 @@ async def antilink_command_handler(client: Client, message: Message):
         await message.edit(f"Error setting anti-link: `{e}`")
 
 # Event handler for anti-link (delete messages with URLs)
-@app.on_message(filters.group & ~filters.me) # Only process messages from others in groups
+# Simple regex for URL detection (can be more sophisticated), compiled once.
+# It is applied as a dispatch filter, so messages without a link never reach the handler.
+_URL_RE = re.compile(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+')
+_URL_FILTER = filters.regex(_URL_RE)
+
+@app.on_message(filters.group & ~filters.me & (filters.text | filters.caption) & _URL_FILTER) # Only messages from others in groups that contain a link
 async def antilink_message_listener(client: Client, message: Message):
     """
-    Listens for messages in groups. If anti-link is enabled,
-    it deletes messages containing common URLs.
+    Listens for messages with links in groups. If anti-link is enabled,
+    it deletes them.
     """
+    # Cheapest checks first: the settings lookup is cached, the rights check may be an API call.
+    if await get_chat_setting_value(message.chat.id, "antilink_status") != "True":
+        return
     # Don't delete messages from admins or if bot doesn't have delete rights
     if not await check_userbot_rights_in_chat(message.chat.id, ['can_delete_messages']):
         return
-    
-    with Session(engine) as session:
-        antilink_setting = session.exec(
-            select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "antilink_status")
-        ).first()
-        
-        if antilink_setting and antilink_setting.value == "True":
-            if message.text or message.caption:
-                text_content = message.text or message.caption
-                # Simple regex for URL detection (can be more sophisticated)
-                url_pattern = r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+'
-                if re.search(url_pattern, text_content):
-                    try:
-                        await message.delete()
-                        # Optional: Send a warning message
-                        # await client.send_message(message.chat.id, f"Link detected and removed from {message.from_user.mention}.", reply_to_message_id=message.id)
-                        logger.info(f"Anti-link: Deleted message with URL from {message.from_user.id} in {message.chat.id}.")
-                    except Forbidden:
-                        logger.warning(f"Anti-link: Bot could not delete message from {message.from_user.id} in {message.chat.id} (permissions lost?).")
-                    except Exception as e:
-                        logger.error(f"Anti-link: Error deleting message: {e}", exc_info=True)
-
-# Placeholder for antiflood
+
+    try:
+        await message.delete()
+        # Optional: Send a warning message
+        # await client.send_message(message.chat.id, f"Link detected and removed from {message.from_user.mention}.", reply_to_message_id=message.id)
+        logger.info(f"Anti-link: Deleted message with URL from {message.from_user.id} in {message.chat.id}.")
+    except Forbidden:
+        logger.warning(f"Anti-link: Bot could not delete message from {message.from_user.id} in {message.chat.id} (permissions lost?).")
+    except Exception as e:
+        logger.error(f"Anti-link: Error deleting message: {e}", exc_info=True)
+
+# Event handler to keep the rights cache fresh when the userbot is promoted/demoted/removed
+@app.on_chat_member_updated()
+async def userbot_rights_changed_listener(client: Client, update: ChatMemberUpdated):
+    """
+    Evicts cached rights checks for a chat when the userbot's own membership there changes.
+    """
+    changed_member = update.new_chat_member or update.old_chat_member
+    if changed_member and changed_member.user and changed_member.user.id == client.me.id:
+        invalidate_rights_cache(update.chat.id)
+        logger.debug("Rights cache invalidated for chat %s.", update.chat.id)
+
+# Anti-flood: per-user sliding window kept in memory, so no DB round trip per message.
+ANTIFLOOD_DEFAULT_THRESHOLD: int = 5 # messages
+ANTIFLOOD_TIME_WINDOW: int = 10 # seconds
+ANTIFLOOD_MUTE_DURATION: timedelta = timedelta(minutes=5)
+
+# {chat_id: {user_id: deque of recent message times}}; each deque holds at most `threshold` entries
+flood_state: Dict[int, Dict[int, deque]] = defaultdict(dict)
+_flood_state_pruned_at: float = 0.0 # time.monotonic() of the last prune_flood_state() sweep
+
+def prune_flood_state(window: float, now: float) -> None:
+    """
+    Drops users whose latest message is older than `window` seconds (they can't be flooding), and empty chats.
+    """
+    for chat_id in list(flood_state):
+        chat_hits = flood_state[chat_id]
+        for user_id in [user_id for user_id, user_hits in chat_hits.items() if now - user_hits[-1] >= window]:
+            del chat_hits[user_id]
+        if not chat_hits:
+            del flood_state[chat_id]
+
+def record_flood_hit(chat_id: int, user_id: int, threshold: int, window: float, now: float) -> bool:
+    """
+    Records a message and returns True if the user has sent `threshold` messages within `window` seconds.
+    """
+    global _flood_state_pruned_at
+    if now - _flood_state_pruned_at >= window: # At most one sweep per window keeps the dict to recently active users
+        prune_flood_state(window, now)
+        _flood_state_pruned_at = now
+    user_hits = flood_state[chat_id].get(user_id)
+    if user_hits is None or user_hits.maxlen != threshold:
+        user_hits = flood_state[chat_id][user_id] = deque(user_hits or (), maxlen=threshold)
+    user_hits.append(now)
+    return len(user_hits) == threshold and (now - user_hits[0]) < window
+
 @app.on_message(filters.me & filters.command("antiflood", prefixes=COMMAND_PREFIX))
 @require_admin_rights(['can_delete_messages', 'can_restrict_members'])
 async def antiflood_command_handler(client: Client, message: Message):
     """
     Handles the .antiflood command to toggle anti-flood protection in a group.
-    (Placeholder - implementation requires tracking user message rates).
+    Users sending `threshold` messages within the time window are muted temporarily.
     """
     logger.info(f"Command {COMMAND_PREFIX}antiflood executed by user {message.from_user.id}.")
-    if not message.chat.type in ["group", "supergroup"]:
+    if message.chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
         await message.edit("`This command only works in groups.`")
         return
 
     args = message.command
-    if len(args) < 2 or args not in ["on", "off"]:
-        await message.edit(f"`Usage: {COMMAND_PREFIX}antiflood [on/off] [threshold (optional, default 5 in 10s)]`")
+    if len(args) < 2 or args[1].lower() not in ("on", "off"):
+        await message.edit(f"`Usage: {COMMAND_PREFIX}antiflood [on/off] [threshold (optional, default {ANTIFLOOD_DEFAULT_THRESHOLD} in {ANTIFLOOD_TIME_WINDOW}s)]`")
         return
 
-    status = (args == "on")
-    threshold = 5 # default messages
-    time_window = 10 # default seconds
+    status = (args[1].lower() == "on")
+    threshold = ANTIFLOOD_DEFAULT_THRESHOLD
+    time_window = ANTIFLOOD_TIME_WINDOW
     
     if len(args) > 2:
         try:
-            threshold = int(args)
+            threshold = int(args[2])
             if threshold <= 0: raise ValueError
         except ValueError:
             await message.edit("`Invalid threshold. Must be a positive integer.`")
             return
 
     try:
-        with Session(engine) as session:
-            chat_setting = session.exec(
-                select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "antiflood_status")
-            ).first()
-            threshold_setting = session.exec(
-                select(ChatSetting).where(ChatSetting.chat_id == message.chat.id, ChatSetting.key == "antiflood_threshold")
-            ).first()
-
-            if chat_setting: chat_setting.value = str(status)
-            else: session.add(ChatSetting(chat_id=message.chat.id, key="antiflood_status", value=str(status)))
-            
-            if threshold_setting: threshold_setting.value = str(threshold)
-            else: session.add(ChatSetting(chat_id=message.chat.id, key="antiflood_threshold", value=str(threshold)))
-            
-            session.commit()
-            await message.edit(f"**Anti-flood protection set to: `{args[1].upper()}` with threshold `{threshold}` messages in `{time_window}` seconds.**\n"
-                               f"*(Actual implementation of anti-flood logic is pending.)*")
-            logger.info(f"Anti-flood set to {args} with threshold {threshold} in chat {message.chat.id}.")
+        async with async_session() as session:
+            await upsert_setting(session, ChatSetting, "chat_id", message.chat.id, "antiflood_status", str(status))
+            await upsert_setting(session, ChatSetting, "chat_id", message.chat.id, "antiflood_threshold", str(threshold))
+            await session.commit()
+            chat_setting_cache[(message.chat.id, "antiflood_status")] = str(status)
+            chat_setting_cache[(message.chat.id, "antiflood_threshold")] = str(threshold)
+            flood_state.pop(message.chat.id, None) # Start counting afresh with the new settings
+            await message.edit(f"**Anti-flood protection set to: `{args[1].upper()}` with threshold `{threshold}` messages in `{time_window}` seconds.**")
+            logger.info(f"Anti-flood set to {args[1]} with threshold {threshold} in chat {message.chat.id}.")
     except Exception as e:
         logger.error(f"Error setting antiflood: {e}", exc_info=True)
         await message.edit(f"Error setting anti-flood: `{e}`")
 
+# Event handler for anti-flood. Registered in its own handler group so it runs
+# alongside the anti-link listener instead of being shadowed by it.
+@app.on_message(filters.group & ~filters.me & ~filters.service, group=1)
+async def antiflood_message_listener(client: Client, message: Message):
+    """
+    Tracks per-user message rates in groups with anti-flood enabled and mutes flooders.
+    """
+    if not message.from_user:
+        return
+    chat_id, user_id = message.chat.id, message.from_user.id
+    if await get_chat_setting_value(chat_id, "antiflood_status") != "True":
+        return
+    threshold = int(await get_chat_setting_value(chat_id, "antiflood_threshold") or ANTIFLOOD_DEFAULT_THRESHOLD)
+    if not record_flood_hit(chat_id, user_id, threshold, ANTIFLOOD_TIME_WINDOW, time.monotonic()):
+        return
+    if not await check_userbot_rights_in_chat(chat_id, ['can_restrict_members']):
+        return
+
+    flood_state[chat_id].pop(user_id, None)
+    try:
+        await with_tg_backoff(client.restrict_chat_member, idempotent=True)(
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=ChatPermissions(can_send_messages=False),
+            until_date=utc_now() + ANTIFLOOD_MUTE_DURATION
+        )
+        await with_tg_backoff(client.send_message)(
+            chat_id=chat_id,
+            text=f"**{message.from_user.mention} muted for `{format_time_difference(ANTIFLOOD_MUTE_DURATION.total_seconds())}` for flooding.**"
+        )
+        logger.info("Anti-flood: Muted %s in %s.", user_id, chat_id)
+    except UserAdminInvalid:
+        logger.warning("Anti-flood: Cannot mute %s in %s (admin?).", user_id, chat_id)
+    except Exception as e:
+        logger.error("Anti-flood: Error muting %s in %s: %s", user_id, chat_id, e)
+
 
 # =========================================================================
 # SECTION 10: IMPLEMENTATION OF AUTOMATION & UTILITY COMMANDS
@@ -3615,76 +4126,205 @@ async def antiflood_command_handler(client: Client, message: Message):
 # -------------------------------------------------------------------------
 # Command: .dl - File downloader from URL.
 # -------------------------------------------------------------------------
+DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024 # 1 MiB; downloads are streamed to disk in chunks of this size
+TELEGRAM_MAX_UPLOAD_SIZE: int = 2 * 1024 ** 3 # 2 GiB, Telegram's per-file limit for regular accounts (also caps .dl)
+DOWNLOAD_SPOOL_MAX_SIZE: int = 8 * 1024 * 1024 # 8 MiB; downloads whose body stays within this are kept in memory
+
+# Most common download types, resolved without going through the mimetypes database
+_MIME_FAST: Dict[str, str] = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "text/html": ".html",
+    "application/json": ".json",
+    "application/zip": ".zip",
+}
+
+# Common media extensions that decide how a download is sent without inspecting the response at all
+_EXT2KIND: Dict[str, str] = {
+    ".jpg": "photo", ".jpeg": "photo", ".png": "photo", ".webp": "photo", ".gif": "photo",
+    ".mp4": "video", ".mov": "video", ".webm": "video",
+}
+
+# Characters that are invalid in file names on common file systems, removed in one C-level pass
+_FNAME_TABLE = str.maketrans('', '', '\\/*?:"<>|')
+
+MAGIC_SNIFF_SIZE: int = 32 # bytes read before streaming the rest
+
+# Magic-byte signatures: (offset, prefix, extension, content type). Servers often omit or
+# mislabel Content-Type, so the first bytes of the body decide the type when they match.
+_MAGIC_SIGNATURES: Tuple[Tuple[int, bytes, str, str], ...] = (
+    (0, b"\xff\xd8\xff", ".jpg", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", ".png", "image/png"),
+    (0, b"GIF8", ".gif", "image/gif"),
+    (8, b"WEBP", ".webp", "image/webp"), # RIFF container
+    (0, b"\x1aE\xdf\xa3", ".webm", "video/webm"), # Matroska/WebM
+    (0, b"%PDF-", ".pdf", "application/pdf"),
+    (0, b"PK\x03\x04", ".zip", "application/zip"),
+)
+
+# ISO base media files (b"ftyp" at offset 4) share one container; the major brand at bytes 8-12 tells them apart.
+# Unlisted brands (isom, mp41, mp42, avc1, ...) are treated as MP4 video.
+_FTYP_BRANDS: Dict[bytes, Tuple[str, str]] = {
+    b"qt  ": (".mov", "video/quicktime"),
+    b"M4A ": (".m4a", "audio/mp4"),
+    b"M4B ": (".m4b", "audio/mp4"),
+    b"heic": (".heic", "image/heic"),
+    b"heix": (".heic", "image/heic"),
+    b"mif1": (".heif", "image/heif"),
+    b"msf1": (".heif", "image/heif-sequence"),
+    b"avif": (".avif", "image/avif"),
+    b"avis": (".avif", "image/avif"),
+    b"3gp4": (".3gp", "video/3gpp"),
+    b"3gp5": (".3gp", "video/3gpp"),
+    b"3g2a": (".3g2", "video/3gpp2"),
+}
+
+def sniff_content_type(head: bytes) -> Optional[Tuple[str, str]]:
+    """
+    Returns (extension, content type) for a known magic-byte signature at the start of a file, else None.
+    """
+    if head.startswith(b"ftyp", 4):
+        return _FTYP_BRANDS.get(head[8:12], (".mp4", "video/mp4"))
+    for offset, prefix, extension, content_type in _MAGIC_SIGNATURES:
+        if head.startswith(prefix, offset):
+            return extension, content_type
+    return None
+
+async def read_download_head(response: aiohttp.ClientResponse) -> bytes:
+    """
+    Reads the first MAGIC_SNIFF_SIZE bytes of the body (fewer only if the whole body is shorter).
+    """
+    try:
+        # read() returns whatever happens to be buffered, which can be too short for offset signatures
+        return await response.content.readexactly(MAGIC_SNIFF_SIZE)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+async def iter_download_chunks(response: aiohttp.ClientResponse, head: bytes):
+    """
+    Yields the already-read `head` and then the rest of the response body,
+    aborting once more than TELEGRAM_MAX_UPLOAD_SIZE bytes have arrived.
+    """
+    downloaded = len(head)
+    if head:
+        yield head
+    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+        # Content-Length may be missing or wrong (chunked transfer), so count as we go
+        downloaded += len(chunk)
+        if downloaded > TELEGRAM_MAX_UPLOAD_SIZE:
+            raise ValueError("download exceeded the 2 GB upload limit")
+        yield chunk
+
 @app.on_message(filters.me & filters.command("dl", prefixes=COMMAND_PREFIX))
 async def download_command_handler(client: Client, message: Message):
     """
     Handles the .dl command to download a file from a given URL and upload it to Telegram.
     """
-    logger.info(f"Command {COMMAND_PREFIX}dl executed by user {message.from_user.id}.")
+    logger.info("Command %sdl executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     url_to_download = await extract_arg(message)
     if not url_to_download:
         await message.edit(f"`Please provide a URL to download! (Example: {COMMAND_PREFIX}dl https://example.com/image.jpg)`")
         return
 
-    await message.edit(f"`Downloading from '{url_to_download}'... 📥`")
-    
+    temp_path: Optional[str] = None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url_to_download, allow_redirects=True, timeout=30) as response:
+        async with deferred_progress(message, f"`Downloading from '{url_to_download}'... 📥`") as finish_progress:
+            async with get_http_session().get(url_to_download, allow_redirects=True) as response:
                 if response.status == 200:
-                    content_type = response.headers.get('Content-Type', 'application/octet-stream')
-                    file_extension = ""
-                    if 'image/' in content_type:
-                        file_extension = "." + content_type.split('/')[-1]
-                    elif 'video/' in content_type:
-                        file_extension = "." + content_type.split('/')[-1]
-                    elif 'text/' in content_type:
-                        file_extension = ".txt"
-                    
-                    filename = os.path.basename(url_to_download.split('?'))
-                    if not "." in filename and file_extension: # Add extension if missing
-                        filename = f"download{file_extension}"
-                    elif not "." in filename: # Fallback
-                        filename = "download.bin"
+                    # Refuse oversized files before reading any of the body
+                    content_length = int(response.headers.get('Content-Length') or 0)
+                    if content_length > TELEGRAM_MAX_UPLOAD_SIZE:
+                        await finish_progress()
+                        await message.edit(f"`File too large to download and upload ({content_length} bytes, limit is 2 GB).`")
+                        return
+
+                    filename = urlsplit(url_to_download).path.rsplit('/', 1)[-1] # Last path segment, no query/fragment
+                    head = b""
+                    # Fast path: a well-known media extension in the URL decides the upload type outright
+                    kind = _EXT2KIND.get(os.path.splitext(filename)[1].lower())
+                    if kind is None:
+                        # The body's first bytes are more trustworthy than the Content-Type header
+                        head = await read_download_head(response)
+                        sniffed = sniff_content_type(head)
+                        if sniffed:
+                            file_extension, content_type = sniffed
+                        else:
+                            # Drop parameters such as "; charset=utf-8" before looking up the extension
+                            content_type = response.headers.get('Content-Type', 'application/octet-stream').split(';', 1)[0].strip().lower()
+                            file_extension = _MIME_FAST.get(content_type) or mimetypes.guess_extension(content_type) or ".bin"
+                        kind = "photo" if content_type.startswith('image/') else "video" if content_type.startswith('video/') else "document"
 
-                    # Ensure filename is not too long or invalid for file systems
-                    filename = re.sub(r'[\\/*?:"<>|]', '', filename)[:100]
+                        if not "." in filename: # Add extension if missing
+                            filename = f"download{file_extension}"
+                        elif sniffed: # Prefer the sniffed extension over the one in the URL
+                            filename = os.path.splitext(filename)[0] + file_extension
 
-                    temp_file = io.BytesIO(await response.read())
-                    temp_file.name = filename # Pyrogram needs this for send_document
+                    # Ensure filename is not too long or invalid for file systems
+                    filename = filename.translate(_FNAME_TABLE)[:100]
+
+                    upload_source: Union[str, io.BytesIO]
+                    chunks = iter_download_chunks(response, head)
+                    buffer = io.BytesIO()
+                    # Small files stay in memory and skip the disk round trip. The limit is checked against the
+                    # bytes actually received: Content-Length may be missing, or smaller than the decompressed body.
+                    spill_to_disk = content_length > DOWNLOAD_SPOOL_MAX_SIZE
+                    if not spill_to_disk:
+                        async for chunk in chunks:
+                            buffer.write(chunk)
+                            if buffer.tell() > DOWNLOAD_SPOOL_MAX_SIZE:
+                                spill_to_disk = True
+                                break
+                    if spill_to_disk:
+                        # Large file: stream the rest to a temp file so only one chunk is held in memory at a time
+                        async with aiofiles.tempfile.NamedTemporaryFile("wb", delete=False, suffix=os.path.splitext(filename)[1]) as tmp:
+                            temp_path = upload_source = tmp.name
+                            await tmp.write(buffer.getvalue())
+                            buffer.close()
+                            async for chunk in chunks:
+                                await tmp.write(chunk)
+                    else:
+                        upload_source = buffer
+                        upload_source.name = filename # Pyrogram needs this for in-memory uploads
+                        upload_source.seek(0)
 
-                    if 'image/' in content_type:
+                    if kind == "photo":
                         await client.send_photo(
                             chat_id=message.chat.id,
-                            photo=temp_file,
+                            photo=upload_source,
                             caption=f"`Downloaded from:` {url_to_download}"
                         )
-                    elif 'video/' in content_type:
+                    elif kind == "video":
                         await client.send_video(
                             chat_id=message.chat.id,
-                            video=temp_file,
+                            video=upload_source,
+                            file_name=filename,
                             caption=f"`Downloaded from:` {url_to_download}"
                         )
                     else:
                         await client.send_document(
                             chat_id=message.chat.id,
-                            document=temp_file,
+                            document=upload_source,
+                            file_name=filename,
                             caption=f"`Downloaded from:` {url_to_download}"
                         )
                     await message.delete()
-                    logger.info(f"File downloaded from {url_to_download} and sent.")
+                    logger.info("File downloaded from %s and sent.", url_to_download)
                 else:
+                    await finish_progress()
                     await message.edit(f"`Failed to download. Status: {response.status}`")
-                    logger.warning(f"Download failed for {url_to_download} with status {response.status}.")
+                    logger.warning("Download failed for %s with status %s.", url_to_download, response.status)
+        # Expected failures (bad URL, unreachable host, timeout) are logged without a traceback
     except aiohttp.ClientError as e:
-        logger.error(f"HTTP Client error during download: {e}", exc_info=True)
+        logger.warning("HTTP Client error during download of %s: %s", url_to_download, e)
         await message.edit(f"`Download failed: HTTP client error. {e}`")
     except asyncio.TimeoutError:
-        logger.error(f"Download timeout for {url_to_download}.", exc_info=True)
+        logger.warning("Download timeout for %s.", url_to_download)
         await message.edit(f"`Download timed out for: {url_to_download}`")
     except Exception as e:
         logger.error(f"Error in dl command: {e}", exc_info=True)
         await message.edit(f"Error downloading file: `{e}`")
+    finally:
+        await remove_file(temp_path)
 
 # -------------------------------------------------------------------------
 # Command: .up - File uploader to Telegram.
@@ -3695,45 +4335,55 @@ async def upload_command_handler(client: Client, message: Message):
     Handles the .up command to upload a local file to Telegram.
     Usage: .up <file_path>
     """
-    logger.info(f"Command {COMMAND_PREFIX}up executed by user {message.from_user.id}.")
+    logger.info("Command %sup executed by user %s.", COMMAND_PREFIX, message.from_user.id)
     file_path = await extract_arg(message)
     if not file_path:
         await message.edit(f"`Please provide a local file path to upload! (Example: {COMMAND_PREFIX}up /tmp/myfile.txt)`")
         return
     
-    if not os.path.exists(file_path):
+    # One stat() off the event loop covers existence, type and size checks
+    try:
+        file_stat = await asyncio.to_thread(os.stat, file_path)
+    except (OSError, ValueError) as e:
+        # Missing, unreadable (PermissionError), too long (ENAMETOOLONG) or malformed (embedded NUL) paths
         await message.edit(f"`File not found at path: {file_path}`")
-        logger.warning(f"File not found for upload: {file_path}")
+        logger.warning("File not found for upload: %s (%s)", file_path, e)
+        return
+    if not stat.S_ISREG(file_stat.st_mode):
+        await message.edit(f"`Not a regular file: {file_path}`")
+        return
+    if file_stat.st_size > TELEGRAM_MAX_UPLOAD_SIZE:
+        await message.edit(f"`File is too large to upload ({file_stat.st_size} bytes, limit is 2 GB).`")
         return
 
-    await message.edit(f"`Uploading '{os.path.basename(file_path)}'... ⬆️`")
     try:
-        # Determine media type (simple guess)
-        mime_type, _ = mimetypes.guess_type(file_path)
-        is_photo = mime_type and mime_type.startswith('image/')
-        is_video = mime_type and mime_type.startswith('video/')
-
-        # Pyrogram automatically handles the file stream
-        if is_photo:
-            await client.send_photo(
-                chat_id=message.chat.id,
-                photo=file_path,
-                caption=f"`Uploaded file:` `{os.path.basename(file_path)}`"
-            )
-        elif is_video:
-            await client.send_video(
-                chat_id=message.chat.id,
-                video=file_path,
-                caption=f"`Uploaded file:` `{os.path.basename(file_path)}`"
-            )
-        else:
-            await client.send_document(
-                chat_id=message.chat.id,
-                document=file_path,
-                caption=f"`Uploaded file:` `{os.path.basename(file_path)}`"
-            )
-        await message.delete()
-        logger.info(f"File '{file_path}' uploaded and sent.")
+        async with deferred_progress(message, f"`Uploading '{os.path.basename(file_path)}'... ⬆️`"):
+            # Determine media type (simple guess)
+            mime_type, _ = mimetypes.guess_type(file_path)
+            is_photo = mime_type and mime_type.startswith('image/')
+            is_video = mime_type and mime_type.startswith('video/')
+
+            # Pyrogram automatically handles the file stream
+            if is_photo:
+                await client.send_photo(
+                    chat_id=message.chat.id,
+                    photo=file_path,
+                    caption=f"`Uploaded file:` `{os.path.basename(file_path)}`"
+                )
+            elif is_video:
+                await client.send_video(
+                    chat_id=message.chat.id,
+                    video=file_path,
+                    caption=f"`Uploaded file:` `{os.path.basename(file_path)}`"
+                )
+            else:
+                await client.send_document(
+                    chat_id=message.chat.id,
+                    document=file_path,
+                    caption=f"`Uploaded file:` `{os.path.basename(file_path)}`"
+                )
+            await message.delete()
+            logger.info("File '%s' uploaded and sent.", file_path)
     except Exception as e:
         logger.error(f"Error in up command: {e}", exc_info=True)
         await message.edit(f"Error uploading file: `{e}`")
@@ -3767,13 +4417,12 @@ async def autoname_command_handler(client: Client, message: Message):
     Usage: .autoname [first_name] [last_name (optional)]
     """
     logger.info(f"Command {COMMAND_PREFIX}autoname executed by user {message.from_user.id}.")
-    args = message.command
-    if len(args) < 2:
-        await message.edit("`Please provide a first name, and optionally a last name.`")
-        return
-
-    first_name = args
-    last_name = " ".join(args[2:]) if len(args) > 2 else ""
+    match message.command:
+        case [_, first_name, *rest]:
+            last_name = " ".join(rest)
+        case _:
+            await message.edit("`Please provide a first name, and optionally a last name.`")
+            return
 
     try:
         await client.update_profile(first_name=first_name, last_name=last_name)
@@ -3786,6 +4435,9 @@ async def autoname_command_handler(client: Client, message: Message):
 # -------------------------------------------------------------------------
 # Command: .scheduled - Scheduled message system (persistent).
 # -------------------------------------------------------------------------
+# Plain Core INSERT, built once: skips the ORM unit of work for a single-row write.
+INSERT_SCHEDULED_MESSAGE = insert(ScheduledMessage)
+
 @app.on_message(filters.me & filters.command("scheduled", prefixes=COMMAND_PREFIX))
 async def scheduled_message_command_handler(client: Client, message: Message):
     """
@@ -3793,34 +4445,34 @@ async def scheduled_message_command_handler(client: Client, message: Message):
     Usage: .scheduled <duration> <message> (e.g., 5m Hello there!)
     """
     logger.info(f"Command {COMMAND_PREFIX}scheduled executed by user {message.from_user.id}.")
-    args = message.command
-    if len(args) < 3:
-        await message.edit(f"`Usage: {COMMAND_PREFIX}scheduled [duration] [message]`\n"
-                           f"`Example: {COMMAND_PREFIX}scheduled 1h Hello World (duration: s, m, h, d)`")
-        return
-
-    duration_str = args
-    message_text = " ".join(args[2:])
+    match message.command:
+        case [_, duration_str, *body] if body:
+            message_text = " ".join(body)
+        case _:
+            await message.edit(f"`Usage: {COMMAND_PREFIX}scheduled [duration] [message]`\n"
+                               f"`Example: {COMMAND_PREFIX}scheduled 1h Hello World (duration: s, m, h, d)`")
+            return
 
     duration = await parse_time_duration(duration_str)
     if not duration:
         await message.edit(f"`Invalid duration format. Use: 1h30m, 2d, 15m, 30s.`")
         return
     
-    send_time = datetime.utcnow() + duration
+    send_time = utc_now() + duration
 
     try:
-        with Session(engine) as session:
-            new_scheduled_msg = ScheduledMessage(
-                user_id=message.from_user.id,
-                chat_id=message.chat.id,
-                send_time=send_time,
-                message_text=message_text,
-                is_sent=False
-            )
-            session.add(new_scheduled_msg)
-            session.commit()
-            session.refresh(new_scheduled_msg)
+        # Shared async sessionmaker: pooled connection, no event-loop blocking, and no refresh SELECT
+        async with async_session() as session:
+            await session.execute(INSERT_SCHEDULED_MESSAGE, {
+                "user_id": message.from_user.id,
+                "chat_id": message.chat.id,
+                "send_time": send_time,
+                "message_text": message_text,
+                "rendered_text": render_scheduled_text(message_text),
+                "is_sent": False,
+            })
+            await session.commit()
+        due_wakeup.set() # Let due_dispatcher re-plan around the new deadline
 
         await message.edit(f"**Message scheduled!** Will send in approximately `{format_time_difference(duration.total_seconds())}` to this chat: `{message_text[:100]}...`")
         logger.info(f"Message scheduled for chat {message.chat.id} by {message.from_user.id}.")
@@ -3831,6 +4483,8 @@ async def scheduled_message_command_handler(client: Client, message: Message):
 # -------------------------------------------------------------------------
 # Command: .count - Counts words/characters/lines.
 # -------------------------------------------------------------------------
+_WORD_RE = re.compile(r'\S+') # A "word" is any run of non-whitespace, same as str.split()
+
 @app.on_message(filters.me & filters.command("count", prefixes=COMMAND_PREFIX))
 async def count_command_handler(client: Client, message: Message):
     """
@@ -3844,7 +4498,7 @@ async def count_command_handler(client: Client, message: Message):
         await message.edit(f"`Please provide text to count or reply to a message.`")
         return
 
-    word_count = len(text.split())
+    word_count = sum(1 for _ in _WORD_RE.finditer(text)) # Counts without building a list of substrings
     char_count = len(text)
     line_count = text.count('\n') + 1
 
@@ -3867,27 +4521,16 @@ async def telegraph_command_handler(client: Client, message: Message):
     This is a simulated command; a real implementation would use the Telegraph API.
     """
     logger.info(f"Command {COMMAND_PREFIX}telegraph executed by user {message.from_user.id}.")
-    args = message.command
-    if len(args) < 2:
-        await message.edit(f"`Usage: {COMMAND_PREFIX}telegraph [title] [author (optional)] [text/reply]`")
-        return
-
     # Extract title, author, and content
-    title = args
-    author = ""
-    content = ""
-
-    # Check for author if it's the second arg and not the start of content
-    if len(args) > 2 and not (args.startswith("http") or message.reply_to_message):
-        author_candidate = args
-        if len(args) > 3 or (not message.reply_to_message and len(args) == 3 and not await get_reply_text(message)):
-            # If there's more after, or no reply and exactly 3 args, assume 2nd is author
-            author = author_candidate
-            content = " ".join(args[3:])
-        else: # 2nd arg must be content
-            content = " ".join(args[2:])
-    elif len(args) > 2: # No explicit author, assume content starts from 2nd arg
-        content = " ".join(args[2:])
+    match message.command:
+        case [_, title, author_candidate, *body] if not (author_candidate.startswith("http") or message.reply_to_message):
+            # Without a reply, the 2nd arg is the author and the rest is the content
+            author, content = author_candidate, " ".join(body)
+        case [_, title, *body]: # No explicit author, content starts from the 2nd arg
+            author, content = "", " ".join(body)
+        case _:
+            await message.edit(f"`Usage: {COMMAND_PREFIX}telegraph [title] [author (optional)] [text/reply]`")
+            return
 
     if not content and message.reply_to_message and message.reply_to_message.text:
         content = message.reply_to_message.text
@@ -3896,7 +4539,7 @@ async def telegraph_command_handler(client: Client, message: Message):
         return
     
     if not author:
-        author = client.me.first_name # Default author
+        author = ME_FIRST_NAME or client.me.first_name # Default author
     
     await message.edit(f"`Creating Telegraph article for '{title}'... (Simulated)`")
     try:
@@ -3928,13 +4571,50 @@ async def telegraph_command_handler(client: Client, message: Message):
         await message.edit(f"Error creating Telegraph article: `{e}`")
 
 # -------------------------------------------------------------------------
-# Command: .imgedit - Basic image editor (Rotate, Resize) (Simulated/Placeholder)
+# Command: .imgedit - Basic image editor (Rotate, Resize).
 # -------------------------------------------------------------------------
+def render_image_edit(photo_path: str, action: str, value: int) -> Optional[Tuple[str, str]]:
+    """
+    Applies an .imgedit action and saves the result to a temp file (runs in a worker thread).
+    Returns (output path, status message), or None if the resize value is out of range.
+    """
+    with Image.open(photo_path) as img:
+        source_format = img.format
+        if action == "rotate":
+            edited_img = img.rotate(value, expand=True) # expand=True adjusts size for rotation
+            status_msg = f"rotated by {value}°"
+        else:
+            original_width, original_height = img.size
+            if value > original_width * 2 or value < 50: # Arbitrary limits
+                return None
+            
+            # Resize keeping aspect ratio, 'value' is new width
+            new_width = value
+            new_height = int(original_height * (new_width / original_width))
+            if new_width * 2 <= original_width:
+                # Large downscale: a cheap BILINEAR pass to 2x the target, then LANCZOS for the final step
+                edited_img = img.resize((new_width * 2, new_height * 2), Image.Resampling.BILINEAR).resize(
+                    (new_width, new_height), Image.Resampling.LANCZOS
+                )
+            else:
+                edited_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            status_msg = f"resized to {new_width}px width"
+
+    # Keep JPEG sources as JPEG (far smaller uploads than a PNG re-encode); anything else stays lossless PNG
+    if source_format == "JPEG" and edited_img.mode in ("RGB", "L"):
+        suffix, save_kwargs = ".jpg", {"format": "JPEG", "quality": 85, "progressive": True, "optimize": True}
+    else:
+        suffix, save_kwargs = ".png", {"format": "PNG", "compress_level": 1} # Fast compression
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as out:
+        edited_img.save(out, **save_kwargs)
+    return out.name, status_msg
+
 @app.on_message(filters.me & filters.command("imgedit", prefixes=COMMAND_PREFIX))
 async def imgedit_command_handler(client: Client, message: Message):
     """
     Handles the .imgedit command for basic image manipulations (rotate, resize).
-    This is a simulated command; a real implementation requires image processing with Pillow.
+    Pillow work runs in a worker thread so the event loop stays responsive.
+    Installing pillow-simd (a drop-in Pillow replacement) speeds up resizing further.
     """
     logger.info(f"Command {COMMAND_PREFIX}imgedit executed by user {message.from_user.id}.")
     if not message.reply_to_message or not message.reply_to_message.photo:
@@ -3942,61 +4622,46 @@ async def imgedit_command_handler(client: Client, message: Message):
         return
 
     args = message.command
-    if len(args) < 3 or args not in ["rotate", "resize"]:
+    if len(args) < 3 or args[1].lower() not in ("rotate", "resize"):
         await message.edit(f"`Usage: {COMMAND_PREFIX}imgedit [rotate/resize] [value] (reply to photo)`\n"
                            f"`Example: {COMMAND_PREFIX}imgedit rotate 90`\n"
                            f"`Example: {COMMAND_PREFIX}imgedit resize 500` (for 500px width, maintains aspect ratio)")
         return
     
-    action = args
+    action = args[1].lower()
     try:
-        value = int(args)
+        value = int(args[2])
     except ValueError:
         await message.edit(f"`Invalid value for {action}. Must be an integer.`")
         return
 
-    await message.edit(f"`Processing image ({action})... 🖼️`")
+    photo_path: Optional[str] = None
+    out_path: Optional[str] = None
     try:
-        photo = message.reply_to_message.photo
-        photo_path = await client.download_media(photo)
+        async with deferred_progress(message, f"`Processing image ({action})... 🖼️`") as finish_progress:
+            photo = message.reply_to_message.photo
+            photo_path = await client.download_media(photo)
         
-        with Image.open(photo_path) as img:
-            edited_img = None
-            if action == "rotate":
-                edited_img = img.rotate(value, expand=True) # expand=True adjusts size for rotation
-                status_msg = f"rotated by {value}°"
-            elif action == "resize":
-                original_width, original_height = img.size
-                if value > original_width * 2 or value < 50: # Arbitrary limits
-                    await message.edit("`Resize value out of reasonable range (50-2x original width).`")
-                    os.remove(photo_path)
-                    return
-                
-                # Resize keeping aspect ratio, 'value' is new width
-                new_width = value
-                new_height = int(original_height * (new_width / original_width))
-                edited_img = img.resize((new_width, new_height), Image.LANCZOS)
-                status_msg = f"resized to {new_width}px width"
-            
-            if edited_img:
-                img_byte_arr = io.BytesIO()
-                edited_img.save(img_byte_arr, format='PNG') # Save as PNG to preserve quality
-                img_byte_arr.seek(0)
-                
-                await client.send_photo(
-                    chat_id=message.chat.id,
-                    photo=img_byte_arr,
-                    caption=f"**Image {status_msg}.**"
-                )
-                await message.delete()
-                logger.info(f"Image edited ({action}) and sent.")
-            else:
-                await message.edit(f"`Failed to perform image edit '{action}'.`")
+            result = await asyncio.to_thread(render_image_edit, photo_path, action, value)
+            if result is None:
+                await finish_progress()
+                await message.edit("`Resize value out of reasonable range (50-2x original width).`")
+                return
+            out_path, status_msg = result
 
-        os.remove(photo_path)
+            await client.send_photo(
+                chat_id=message.chat.id,
+                photo=out_path,
+                caption=f"**Image {status_msg}.**"
+            )
+            await message.delete()
+            logger.info(f"Image edited ({action}) and sent.")
     except Exception as e:
         logger.error(f"Error in imgedit command: {e}", exc_info=True)
         await message.edit(f"Error editing image: `{e}`")
+    finally:
+        await remove_file(photo_path)
+        await remove_file(out_path)
 
 # -------------------------------------------------------------------------
 # Commands: .tofile, .tosticker, .tovoice - Media conversion utilities.
@@ -4011,23 +4676,25 @@ async def tofile_command_handler(client: Client, message: Message):
         await message.edit("`Please reply to a media message to convert it to a file.`")
         return
 
-    await message.edit("`Converting media to file... 💾`")
+    file_path: Optional[str] = None
     try:
-        # Download the media
-        file_path = await client.download_media(message.reply_to_message)
+        async with deferred_progress(message, "`Converting media to file... 💾`"):
+            # Download the media
+            file_path = await client.download_media(message.reply_to_message)
         
-        # Send as a document
-        await client.send_document(
-            chat_id=message.chat.id,
-            document=file_path,
-            caption=f"`Original media converted to file.`"
-        )
-        await message.delete()
-        logger.info(f"Media converted to file: {file_path}.")
-        os.remove(file_path) # Clean up downloaded file
+            # Send as a document
+            await client.send_document(
+                chat_id=message.chat.id,
+                document=file_path,
+                caption=f"`Original media converted to file.`"
+            )
+            await message.delete()
+            logger.info(f"Media converted to file: {file_path}.")
     except Exception as e:
         logger.error(f"Error in tofile command: {e}", exc_info=True)
         await message.edit(f"Error converting media to file: `{e}`")
+    finally:
+        await remove_file(file_path) # Clean up downloaded file
 
 @app.on_message(filters.me & filters.command("tosticker", prefixes=COMMAND_PREFIX))
 async def tosticker_command_handler(client: Client, message: Message):
@@ -4035,19 +4702,24 @@ async def tosticker_command_handler(client: Client, message: Message):
     Converts a replied photo to a static sticker. Similar to .sticker but specifically for photos.
     """
     logger.info(f"Command {COMMAND_PREFIX}tosticker executed by user {message.from_user.id}.")
-    if not message.reply_to_message or not message.reply_to_message.photo:
-        await message.edit(f"`Please reply to a photo message to convert it into a sticker.`")
-        return
-    
-    # Delegate to the existing sticker command handler
-    await sticker_command_handler(client, message)
+    await convert_to_sticker(client, message) # Shared implementation, which also checks for a replied photo
 
 
+# gTTS is blocking (HTTP + file I/O), so it runs on its own small pool instead of the event loop
+_TTS_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tts")
+
+def synthesize_speech_to_file(text: str) -> str:
+    """
+    Renders text to speech with gTTS and returns the path of the temporary MP3 file (runs in _TTS_POOL).
+    """
+    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as out:
+        gTTS(text=text, lang='en').write_to_fp(out)
+    return out.name
+
 @app.on_message(filters.me & filters.command("tovoice", prefixes=COMMAND_PREFIX))
 async def tovoice_command_handler(client: Client, message: Message):
     """
-    Converts a replied text message into a simulated voice message (Text-to-Speech).
-    This is a placeholder/simulated command, requiring a TTS library or API.
+    Converts a replied text message into a voice message (Text-to-Speech via gTTS).
     """
     logger.info(f"Command {COMMAND_PREFIX}tovoice executed by user {message.from_user.id}.")
     text_to_convert = await get_reply_text(message)
@@ -4055,34 +4727,23 @@ async def tovoice_command_handler(client: Client, message: Message):
         await message.edit("`Please reply to a text message to convert it to a voice message.`")
         return
 
-    await message.edit(f"`Converting text to voice... 🎤 (Simulated)`")
+    voice_path: Optional[str] = None
     try:
-        # Real implementation would involve:
-        # 1. Using a TTS library (e.g., gTTS for Google TTS, pip install gTTS)
-        # 2. Saving the generated audio to an in-memory BytesIO object (as .ogg for Telegram voice)
-        # 3. Sending the BytesIO object as a voice message.
-        
-        # from gtts import gTTS
-        # tts = gTTS(text=text_to_convert, lang='en')
-        # audio_bytes = io.BytesIO()
-        # tts.write_to_fp(audio_bytes)
-        # audio_bytes.seek(0)
-        # audio_bytes.name = "voice.ogg" # Telegram expects OGG for voice messages
-
-        # await client.send_voice(
-        #     chat_id=message.chat.id,
-        #     voice=audio_bytes,
-        #     caption=f"`Voice message from text.`"
-        # )
-
-        # For simulation: just confirm
-        await message.edit(f"**Text converted to voice (simulated):** `{text_to_convert[:50]}...`\n"
-                           f"*(For real conversion, a TTS library like gTTS is needed.)*")
-        logger.info(f"Simulated TTS for text: '{text_to_convert[:50]}...'.")
-
+        async with deferred_progress(message, "`Converting text to voice... 🎤`"):
+            voice_path = await asyncio.get_running_loop().run_in_executor(_TTS_POOL, synthesize_speech_to_file, text_to_convert)
+            # Sent from disk, so the audio is never held in memory as a whole
+            await client.send_voice(
+                chat_id=message.chat.id,
+                voice=voice_path,
+                caption=f"`Voice message from text.`"
+            )
+            await message.delete()
+            logger.info(f"TTS voice sent for text: '{text_to_convert[:50]}...'.")
     except Exception as e:
-        logger.error(f"Error in tovoice command (simulated): {e}", exc_info=True)
+        logger.error(f"Error in tovoice command: {e}", exc_info=True)
         await message.edit(f"Error converting to voice: `{e}`")
+    finally:
+        await remove_file(voice_path)
 
 
 # =========================================================================
@@ -4099,12 +4760,25 @@ async def help_command_handler(client: Client, message: Message):
     logger.info(f"Command {COMMAND_PREFIX}help executed by user {message.from_user.id}.")
     await show_main_help_menu(message)
 
-async def show_main_help_menu(message: Message):
-    """Generates and displays the main help menu with categorized buttons."""
-    help_text = "**👋 Your Self-Account Bot Help Panel 👋**\n\n"
-    help_text += "*Click on a category button to view its commands.*\n"
-    help_text += f"*All commands start with `{COMMAND_PREFIX}`.\n"
-    
+# COMMANDS is static, so the main menu text and keyboard are built once and reused.
+MAIN_HELP_TEXT: str = (
+    "**👋 Your Self-Account Bot Help Panel 👋**\n\n"
+    "*Click on a category button to view its commands.*\n"
+    f"*All commands start with `{COMMAND_PREFIX}`.\n"
+)
+
+# Per-category help pages, rendered once instead of on every button press.
+CATEGORY_HELP_TEXTS: Dict[str, str] = {
+    category_name: f"**📚 Commands in {category_name}:**\n\n" + "".join(
+        f"• `{COMMAND_PREFIX}{cmd}`: {desc}\n" for cmd, desc in commands_in_category.items()
+    )
+    for category_name, commands_in_category in COMMANDS.items()
+}
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(text="⬅️ Back to Main Menu", callback_data="help_main_menu")]])
+
+@cache
+def build_main_help_markup() -> InlineKeyboardMarkup:
+    """Builds the category keyboard for the main help menu (memoized)."""
     buttons: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
     
@@ -4115,9 +4789,12 @@ async def show_main_help_menu(message: Message):
             row = []
     if row: # Add the last row if it's not full
         buttons.append(row)
+    return InlineKeyboardMarkup(buttons)
 
+async def show_main_help_menu(message: Message):
+    """Displays the main help menu with categorized buttons."""
     try:
-        await message.edit(help_text, reply_markup=InlineKeyboardMarkup(buttons))
+        await message.edit(MAIN_HELP_TEXT, reply_markup=build_main_help_markup())
         logger.info("Main help panel displayed.")
     except Exception as e:
         logger.error(f"Error displaying main help panel: {e}", exc_info=True)
@@ -4131,23 +4808,16 @@ async def help_category_callback_handler(client: Client, callback_query: Callbac
     logger.info(f"Callback query '{callback_query.data}' received from user {callback_query.from_user.id}.")
     category_name = callback_query.data.replace("help_cat_", "")
     
-    if category_name not in COMMANDS:
+    category_help_text = CATEGORY_HELP_TEXTS.get(category_name)
+    if category_help_text is None:
         await callback_query.answer("Category not found!", show_alert=True)
         logger.warning(f"Help category '{category_name}' not found.")
         return
-
-    commands_in_category = COMMANDS[category_name]
-    category_help_text = f"**📚 Commands in {category_name}:**\n\n"
-    for cmd, desc in commands_in_category.items():
-        category_help_text += f"• `{COMMAND_PREFIX}{cmd}`: {desc}\n"
-    
-    # Add a 'Back to Main Menu' button
-    back_button = InlineKeyboardButton(text="⬅️ Back to Main Menu", callback_data="help_main_menu")
     
     try:
         await callback_query.edit_message_text(
             category_help_text,
-            reply_markup=InlineKeyboardMarkup([[back_button]])
+            reply_markup=BACK_MARKUP # 'Back to Main Menu' button
         )
         logger.info(f"Help category '{category_name}' displayed.")
         await callback_query.answer() # Acknowledge the callback query
@@ -4162,22 +4832,8 @@ async def help_main_menu_callback_handler(client: Client, callback_query: Callba
     """
     logger.info(f"Callback query '{callback_query.data}' received from user {callback_query.from_user.id}.")
     # Re-display the main help menu
-    help_text = "**👋 Your Self-Account Bot Help Panel 👋**\n\n"
-    help_text += "*Click on a category button to view its commands.*\n"
-    help_text += f"*All commands start with `{COMMAND_PREFIX}`.\n"
-    
-    buttons: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
-    for category_name in COMMANDS.keys():
-        row.append(InlineKeyboardButton(text=category_name, callback_data=f"help_cat_{category_name}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-
     try:
-        await callback_query.edit_message_text(help_text, reply_markup=InlineKeyboardMarkup(buttons))
+        await callback_query.edit_message_text(MAIN_HELP_TEXT, reply_markup=build_main_help_markup())
         logger.info("Returned to main help panel.")
         await callback_query.answer()
     except Exception as e:
@@ -4191,100 +4847,302 @@ async def help_main_menu_callback_handler(client: Client, callback_query: Callba
 # tasks that run periodically in the background.
 # =========================================================================
 
-# Background task for checking and sending scheduled messages
-async def scheduled_message_task():
+# The background senders sleep until the earliest pending deadline instead of polling.
+SCHEDULER_MAX_SLEEP: float = 3600.0 # seconds; safety net so rows added behind our back are still found
+SCHEDULER_RETRY_DELAY: float = 30.0 # seconds; retry interval for rows that are due but failed to send
+
+async def wait_until_next_due(wakeup: asyncio.Event, next_due: Optional[datetime]) -> None:
     """
-    Background task that periodically checks for due scheduled messages
-    and sends them to the respective chats.
+    Sleeps until `next_due` (capped at SCHEDULER_MAX_SLEEP) or until `wakeup` is set, whichever comes first.
     """
-    while True:
-        await asyncio.sleep(30) # Check every 30 seconds
-        logger.debug("Running scheduled message check.")
-        with Session(engine) as session:
-            try:
-                # Find active scheduled messages that are due
-                due_messages = session.exec(
-                    select(ScheduledMessage).where(
-                        ScheduledMessage.is_sent == False,
-                        ScheduledMessage.send_time <= datetime.utcnow()
-                    )
-                ).all()
+    delay = SCHEDULER_MAX_SLEEP
+    if next_due is not None:
+        # Rows still due right after a pass are ones that failed to send; back off before retrying them
+        delay = min(delay, (next_due - utc_now()).total_seconds())
+        if delay <= 0:
+            delay = SCHEDULER_RETRY_DELAY
+    try:
+        await asyncio.wait_for(wakeup.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        wakeup.clear()
+
+SCHEDULER_SEND_CONCURRENCY: int = 10 # Max due messages/reminders being sent at once
+scheduler_send_slots = asyncio.Semaphore(SCHEDULER_SEND_CONCURRENCY)
+# {chat_id: time.monotonic() deadline} of chats that answered with FloodWait; sends there are
+# skipped (and their rows parked until then) instead of re-triggering it
+flood_until: Dict[int, float] = {}
+# Outcomes of one send attempt, as returned by send_scheduled_message() / send_reminder()
+SEND_DONE = "done" # Delivered, or failed permanently: finish the row
+SEND_RETRY = "retry" # Failed transiently: back the row off exponentially and retry it
+SEND_DEFERRED = "deferred" # Not attempted because the chat is under FloodWait: parked until the flood is over
+SCHEDULER_MAX_RETRIES: int = 8 # Transient failures after which a row is given up on
+
+def retry_backoff(retry_count: int) -> timedelta:
+    """
+    Returns how long a row that has already failed `retry_count` times waits before its next attempt.
+    """
+    return timedelta(seconds=min(SCHEDULER_RETRY_DELAY * 2 ** retry_count, SCHEDULER_MAX_SLEEP))
+
+def transient_failure_outcome(kind: str, row: Row) -> str:
+    """
+    Returns SEND_RETRY for a row whose send failed transiently, or SEND_DONE once it has used up its retries.
+    """
+    if row.retry_count + 1 >= SCHEDULER_MAX_RETRIES:
+        logger.error("Giving up on %s %s to %s after %s attempts.", kind, row.id, row.chat_id, row.retry_count + 1)
+        return SEND_DONE
+    return SEND_RETRY
+
+# Max rows of each kind claimed per pass; bounds memory after downtime leaves a large backlog
+DUE_BATCH_SIZE: int = 200
+# Claimed rows are streamed from the cursor and sent in chunks of this size
+DUE_STREAM_CHUNK: int = 50
+
+# The dispatcher's statements are built once; only the `now` parameter changes between passes, so
+# each execution is a plain lookup in SQLAlchemy's compiled-statement cache.
+# Due rows are claimed with FOR UPDATE SKIP LOCKED (a no-op on SQLite) and the locks are held until
+# the pass commits, so several dispatcher processes never send the same row twice.
+DUE_SCHEDULED_MESSAGES_STMT = (
+    select(
+        ScheduledMessage.id, ScheduledMessage.chat_id, ScheduledMessage.retry_count,
+        ScheduledMessage.rendered_text, ScheduledMessage.message_text
+    ).where(
+        ScheduledMessage.is_sent == False,
+        ScheduledMessage.send_time <= bindparam("now"),
+        or_(ScheduledMessage.next_retry_at == None, ScheduledMessage.next_retry_at <= bindparam("now"))
+    ).order_by(ScheduledMessage.send_time).limit(DUE_BATCH_SIZE).with_for_update(skip_locked=True)
+    .execution_options(yield_per=DUE_STREAM_CHUNK)
+)
+DUE_REMINDERS_STMT = (
+    select(
+        Reminder.id, Reminder.user_id, Reminder.chat_id, Reminder.message_id, Reminder.retry_count,
+        Reminder.rendered_text, Reminder.text
+    ).where(
+        Reminder.is_active == True,
+        Reminder.remind_time <= bindparam("now"),
+        or_(Reminder.next_retry_at == None, Reminder.next_retry_at <= bindparam("now"))
+    ).order_by(Reminder.remind_time).limit(DUE_BATCH_SIZE).with_for_update(skip_locked=True)
+    .execution_options(yield_per=DUE_STREAM_CHUNK)
+)
+NEXT_SCHEDULED_MESSAGE_DUE_STMT = (
+    select(func.min(func.coalesce(ScheduledMessage.next_retry_at, ScheduledMessage.send_time)))
+    .where(ScheduledMessage.is_sent == False)
+)
+NEXT_REMINDER_DUE_STMT = (
+    select(func.min(func.coalesce(Reminder.next_retry_at, Reminder.remind_time)))
+    .where(Reminder.is_active == True)
+)
 
-                for msg in due_messages:
-                    try:
-                        await app.send_message(
-                            chat_id=msg.chat_id,
-                            text=f"**⏰ Scheduled Reminder:**\n`{msg.message_text}`"
-                        )
-                        msg.is_sent = True # Mark as sent
-                        session.add(msg)
-                        logger.info(f"Sent scheduled message {msg.id} to chat {msg.chat_id}.")
-                    except Forbidden:
-                        logger.warning(f"Failed to send scheduled message {msg.id} to {msg.chat_id}: Bot forbidden (left chat?).")
-                        msg.is_sent = True # Mark as sent to avoid repeated attempts
-                        session.add(msg)
-                    except Exception as e:
-                        logger.error(f"Error sending scheduled message {msg.id} to {msg.chat_id}: {e}", exc_info=True)
-                
-                session.commit()
-            except Exception as e:
-                logger.error(f"Error in scheduled message background task: {e}", exc_info=True)
+def is_flood_limited(chat_id: int) -> bool:
+    """
+    Returns True while a FloodWait received for `chat_id` is still in effect.
+    """
+    deadline = flood_until.get(chat_id)
+    if deadline is None:
+        return False
+    if time.monotonic() < deadline:
+        return True
+    del flood_until[chat_id]
+    return False
 
-# Background task for checking and sending reminders
-async def reminder_task():
+async def send_scheduled_message(msg: Row) -> str:
     """
-    Background task that periodically checks for due reminders
-    and notifies the user.
+    Sends one due scheduled message (a row from due_dispatcher's column select).
+    Returns SEND_DONE, SEND_RETRY or SEND_DEFERRED.
     """
-    while True:
-        await asyncio.sleep(15) # Check every 15 seconds
-        logger.debug("Running reminder check.")
-        with Session(engine) as session:
-            try:
-                # Find active reminders that are due
-                due_reminders = session.exec(
-                    select(Reminder).where(
-                        Reminder.is_active == True,
-                        Reminder.remind_time <= datetime.utcnow()
+    if is_flood_limited(msg.chat_id):
+        return SEND_DEFERRED
+    async with scheduler_send_slots:
+        try:
+            await app.send_message(
+                chat_id=msg.chat_id,
+                text=msg.rendered_text or render_scheduled_text(msg.message_text)
+            )
+            logger.info("Sent scheduled message %s to chat %s.", msg.id, msg.chat_id)
+            return SEND_DONE
+        except (FloodWait, SlowmodeWait) as e:
+            logger.warning("%s of %ss sending scheduled message %s to %s; retrying later.", type(e).__name__, e.value, msg.id, msg.chat_id)
+            flood_until[msg.chat_id] = time.monotonic() + e.value
+            return SEND_DEFERRED
+        except (Forbidden, BadRequest) as e:
+            # Permanent: the chat is unreachable (left, blocked, no write rights) or the request itself is invalid
+            logger.warning("Failed to send scheduled message %s to %s, dropping it: %s", msg.id, msg.chat_id, e)
+            return SEND_DONE # Mark as sent to avoid repeated attempts
+        except Exception as e:
+            logger.error("Error sending scheduled message %s to %s: %s", msg.id, msg.chat_id, e, exc_info=True)
+            return transient_failure_outcome("scheduled message", msg)
+
+async def send_reminder(rem: Row) -> str:
+    """
+    Sends one due reminder (a row from due_dispatcher's column select).
+    Returns SEND_DONE, SEND_RETRY or SEND_DEFERRED.
+    """
+    if is_flood_limited(rem.chat_id):
+        return SEND_DEFERRED
+    reminder_text = rem.rendered_text or render_reminder_text(rem.text)
+    async with scheduler_send_slots:
+        try:
+            # Attempt to reply to original message, or send new message
+            if rem.message_id:
+                try:
+                    await app.send_message(
+                        chat_id=rem.chat_id,
+                        text=reminder_text,
+                        reply_to_message_id=rem.message_id
                     )
-                ).all()
-
-                for rem in due_reminders:
-                    try:
-                        # Attempt to reply to original message, or send new message
-                        if rem.message_id:
-                            try:
-                                await app.send_message(
-                                    chat_id=rem.chat_id,
-                                    text=f"**🔔 REMINDER:** `{rem.text}`",
-                                    reply_to_message_id=rem.message_id
-                                )
-                            except MessageIdInvalid:
-                                # Original message deleted, send as a new message
-                                await app.send_message(
-                                    chat_id=rem.chat_id,
-                                    text=f"**🔔 REMINDER:** `{rem.text}`"
-                                )
-                        else:
-                             await app.send_message(
-                                chat_id=rem.chat_id,
-                                text=f"**🔔 REMINDER:** `{rem.text}`"
-                            )
-                        
-                        rem.is_active = False # Mark as inactive (sent)
-                        session.add(rem)
-                        logger.info(f"Sent reminder {rem.id} to user {rem.user_id} in chat {rem.chat_id}.")
-                    except Forbidden:
-                        logger.warning(f"Failed to send reminder {rem.id} to {rem.chat_id}: Bot forbidden (left chat?).")
-                        rem.is_active = False # Mark as inactive
-                        session.add(rem)
-                    except Exception as e:
-                        logger.error(f"Error sending reminder {rem.id} to {rem.user_id} in {rem.chat.id}: {e}", exc_info=True)
-                
-                session.commit()
-            except Exception as e:
-                logger.error(f"Error in reminder background task: {e}", exc_info=True)
+                except MessageIdInvalid:
+                    # Original message deleted, send as a new message
+                    await app.send_message(
+                        chat_id=rem.chat_id,
+                        text=reminder_text
+                    )
+            else:
+                await app.send_message(
+                    chat_id=rem.chat_id,
+                    text=reminder_text
+                )
+            
+            logger.info("Sent reminder %s to user %s in chat %s.", rem.id, rem.user_id, rem.chat_id)
+            return SEND_DONE
+        except (FloodWait, SlowmodeWait) as e:
+            logger.warning("%s of %ss sending reminder %s to %s; retrying later.", type(e).__name__, e.value, rem.id, rem.chat_id)
+            flood_until[rem.chat_id] = time.monotonic() + e.value
+            return SEND_DEFERRED
+        except (Forbidden, BadRequest) as e:
+            # Permanent: the chat is unreachable (left, blocked, no write rights) or the request itself is invalid
+            logger.warning("Failed to send reminder %s to %s, dropping it: %s", rem.id, rem.chat_id, e)
+            return SEND_DONE # Mark as inactive
+        except Exception as e:
+            logger.error("Error sending reminder %s to %s in %s: %s", rem.id, rem.user_id, rem.chat_id, e, exc_info=True)
+            return transient_failure_outcome("reminder", rem)
+
+class DispatchOutcomes:
+    """
+    Ids of the rows one table's dispatch pass handled, grouped by how each row must be updated.
+    """
+    def __init__(self) -> None:
+        self.done_ids: List[int] = []
+        self.retry_ids: Dict[int, List[int]] = defaultdict(list) # Grouped by the row's current retry_count
+        self.deferred_ids: Dict[int, List[int]] = defaultdict(list) # Grouped by the chat under FloodWait
+
+    def __bool__(self) -> bool:
+        return bool(self.done_ids or self.retry_ids or self.deferred_ids)
+
+async def dispatch_due_rows(session: AsyncSession, statement, now: datetime, send, outcomes: DispatchOutcomes) -> int:
+    """
+    Streams the rows selected by `statement` (due as of `now`) in chunks of DUE_STREAM_CHUNK and sends each chunk
+    concurrently (bounded by scheduler_send_slots) with `send`, so sending starts after the first chunk.
+    Records each row's outcome in `outcomes` as its chunk completes and returns the number of rows read.
+    Updating them is left to the caller, after the cursor is exhausted.
+    """
+    row_count = 0
+    result = await session.stream(statement, params={"now": now})
+    async for chunk in result.partitions():
+        row_count += len(chunk)
+        results = await asyncio.gather(*(send(row) for row in chunk), return_exceptions=True)
+        for row, outcome in zip(chunk, results):
+            if outcome == SEND_DONE:
+                outcomes.done_ids.append(row.id)
+            elif outcome == SEND_RETRY:
+                outcomes.retry_ids[row.retry_count].append(row.id)
+            elif outcome == SEND_DEFERRED:
+                outcomes.deferred_ids[row.chat_id].append(row.id)
+    return row_count
+
+async def schedule_retries(session: AsyncSession, model, retry_ids: Dict[int, List[int]], now: datetime) -> None:
+    """
+    Bumps retry_count and pushes next_retry_at out by retry_backoff(), with one UPDATE per distinct retry_count.
+    """
+    for retry_count, ids in retry_ids.items():
+        await session.execute(
+            update(model).where(model.id.in_(ids))
+            .values(retry_count=retry_count + 1, next_retry_at=now + retry_backoff(retry_count))
+        )
 
+async def defer_flood_limited(session: AsyncSession, model, deferred_ids: Dict[int, List[int]]) -> None:
+    """
+    Parks rows of chats under FloodWait until the flood is over by setting next_retry_at (retry_count is
+    left alone), so they drop out of the due-row claims instead of filling every batch in the meantime.
+    """
+    for chat_id, ids in deferred_ids.items():
+        remaining = flood_until.get(chat_id, 0.0) - time.monotonic()
+        if remaining > 0:
+            await session.execute(
+                update(model).where(model.id.in_(ids))
+                .values(next_retry_at=utc_now() + timedelta(seconds=remaining))
+            )
+
+async def mark_dispatched(
+    session: AsyncSession, model, done_values: Dict[str, Any], outcomes: DispatchOutcomes, now: datetime
+) -> None:
+    """
+    Applies one table's outcomes of a dispatch pass: one UPDATE setting `done_values` on the finished rows,
+    plus the retry backoffs and FloodWait deferrals. The caller commits.
+    """
+    if outcomes.done_ids:
+        await session.execute(update(model).where(model.id.in_(outcomes.done_ids)).values(**done_values))
+    await schedule_retries(session, model, outcomes.retry_ids, now)
+    await defer_flood_limited(session, model, outcomes.deferred_ids)
+
+# Background task for sending due scheduled messages and reminders
+async def due_dispatcher():
+    """
+    Background task that sends due scheduled messages and reminders in one pass,
+    then sleeps until the earliest pending deadline (or until a new one is added).
+    """
+    # One async session for the task's lifetime, so DB round trips yield to the event loop instead of
+    # blocking it; each pass checks a pooled connection out and back in.
+    # Only plain column tuples are selected, so no ORM objects are built or tracked between passes.
+    async with async_session() as session:
+        while True:
+            logger.debug("Running due message/reminder check.")
+            next_due: Optional[datetime] = None
+            backlog = False
+            now = utc_now() # One timestamp per pass
+            message_outcomes = DispatchOutcomes()
+            reminder_outcomes = DispatchOutcomes()
+            try:
+                message_count = await dispatch_due_rows(
+                    session, DUE_SCHEDULED_MESSAGES_STMT, now, send_scheduled_message, message_outcomes
+                )
+                reminder_count = await dispatch_due_rows(
+                    session, DUE_REMINDERS_STMT, now, send_reminder, reminder_outcomes
+                )
+
+                # One UPDATE per table for the whole batch instead of one per row
+                await mark_dispatched(session, ScheduledMessage, {"is_sent": True}, message_outcomes, now)
+                await mark_dispatched(session, Reminder, {"is_active": False}, reminder_outcomes, now)
+                # Look up the next deadline inside the same transaction: the commit below must be the
+                # pass's last statement, or a new transaction would hold a connection through the sleep
+                deadlines = (
+                    (await session.exec(NEXT_SCHEDULED_MESSAGE_DUE_STMT)).first(),
+                    (await session.exec(NEXT_REMINDER_DUE_STMT)).first(),
+                )
+                await session.commit()
+                next_due = min((deadline for deadline in deadlines if deadline is not None), default=None)
+                # A full batch that updated rows means more rows are probably due right now
+                # (every handled row leaves the claim: finished, backed off, or deferred past its FloodWait)
+                backlog = (
+                    (message_count == DUE_BATCH_SIZE or reminder_count == DUE_BATCH_SIZE)
+                    and bool(message_outcomes or reminder_outcomes)
+                )
+            except asyncio.CancelledError:
+                # Shutting down mid-pass: record the chunks already sent so they aren't sent again after a restart
+                try:
+                    await mark_dispatched(session, ScheduledMessage, {"is_sent": True}, message_outcomes, now)
+                    await mark_dispatched(session, Reminder, {"is_active": False}, reminder_outcomes, now)
+                    await session.commit()
+                except Exception as e:
+                    logger.error("Could not record dispatched rows on shutdown: %s", e)
+                raise
+            except Exception as e:
+                await session.rollback()
+                logger.error("Error in due message/reminder background task: %s", e, exc_info=True)
+                next_due = now + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+            if backlog:
+                continue
+            await wait_until_next_due(due_wakeup, next_due)
 
 # =========================================================================
 # SECTION 13: BOT STARTUP AND SHUTDOWN MANAGEMENT
@@ -4296,21 +5154,31 @@ async def main_runner():
     Main function to start and manage the userbot.
     Initializes Pyrogram client, starts background tasks, and waits for termination.
     """
+    global ME_FIRST_NAME
     logger.info("Userbot starting up...")
+    background_tasks: List[asyncio.Task] = []
     try:
         await app.start()
         me = await app.get_me()
+        ME_FIRST_NAME = me.first_name
         logger.info(f"Userbot successfully started! As: {me.first_name} (@{me.username or me.id})")
         print(f"Userbot successfully started! As: {me.first_name} (@{me.username or me.id})")
         print(f"For commands, send '{COMMAND_PREFIX}help' in Telegram.")
         print("To stop the bot, press Ctrl+C.")
 
         # Start background tasks
-        asyncio.create_task(scheduled_message_task())
-        asyncio.create_task(reminder_task())
+        background_tasks.append(asyncio.create_task(due_dispatcher(), name="due_dispatcher"))
         logger.info("Background tasks started.")
 
-        await idle() # Keep the bot running indefinitely
+        # Block until SIGINT/SIGTERM; the loop sleeps in the selector rather than waking to poll
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError: # Windows: Ctrl+C still ends asyncio.run() via KeyboardInterrupt
+                pass
+        await stop_event.wait()
     except FloodWait as e:
         logger.critical(f"FloodWait during startup/runtime: {e.value} seconds. Please be patient.", exc_info=True)
         print(f"⚠️ FloodWait occurred. Please wait {e.value} seconds and try again.")
@@ -4322,11 +5190,19 @@ async def main_runner():
         print(f"❌ Unknown error during startup: {e}")
     finally:
         logger.info("Userbot stopping...")
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        await close_http_session()
         if app.is_connected:
             await app.stop()
         logger.info("Userbot stopped.")
         print("Userbot stopped.")
 
 if __name__ == "__main__":
-    import mimetypes # Import here to avoid circular dependencies if used globally elsewhere
+    try:
+        import uvloop # Faster event loop; optional and unavailable on Windows
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main_runner())
@@ -0,0 +1,38 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def self2(tmp_path_factory):
+    """
+    Imports the bot module against a scratch database and working directory.
+    """
+    pytest.importorskip("pyrogram")
+    pytest.importorskip("sqlmodel")
+    workdir = tmp_path_factory.mktemp("self2")
+    env = {
+        "DATABASE_URL": f"sqlite:///{workdir / 'import.db'}",
+        "API_ID": os.environ.get("API_ID", "1"),
+        "API_HASH": os.environ.get("API_HASH", "test"),
+    }
+    saved_env = {key: os.environ.get(key) for key in (*env, "ASYNC_DATABASE_URL")}
+    saved_cwd = os.getcwd()
+    os.environ.update(env)
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    os.chdir(workdir) # The module writes userbot.log to the working directory
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        yield importlib.import_module("self2")
+    finally:
+        sys.path.remove(REPO_ROOT)
+        os.chdir(saved_cwd)
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
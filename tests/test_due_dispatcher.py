@@ -0,0 +1,96 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip("pyrogram")
+pytest.importorskip("sqlmodel")
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlmodel import SQLModel, select
+
+FLOODED_CHAT = 100
+OTHER_CHAT = 200
+
+
+@pytest.fixture
+def async_engine(self2, tmp_path):
+    """
+    An async engine on a fresh database with the bot's tables.
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'dispatch.db'}")
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    asyncio.run(create_tables())
+    yield engine
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def flooded_chat(self2):
+    """
+    Puts FLOODED_CHAT under a FloodWait for the duration of the test.
+    """
+    self2.flood_until[FLOODED_CHAT] = time.monotonic() + 60
+    yield FLOODED_CHAT
+    self2.flood_until.pop(FLOODED_CHAT, None)
+
+
+def run_pass(self2, engine, send, now):
+    """
+    Runs one dispatch pass over the scheduled messages and returns (rows claimed, outcomes).
+    """
+    async def dispatch():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            outcomes = self2.DispatchOutcomes()
+            count = await self2.dispatch_due_rows(session, self2.DUE_SCHEDULED_MESSAGES_STMT, now, send, outcomes)
+            await self2.mark_dispatched(session, self2.ScheduledMessage, {"is_sent": True}, outcomes, now)
+            await session.commit()
+            return count, outcomes
+
+    return asyncio.run(dispatch())
+
+
+def test_flood_limited_rows_do_not_starve_other_chats(self2, async_engine, flooded_chat, monkeypatch):
+    monkeypatch.setattr(
+        self2, "DUE_SCHEDULED_MESSAGES_STMT", self2.DUE_SCHEDULED_MESSAGES_STMT.limit(2)
+    )
+    now = self2.utc_now()
+
+    async def add_rows():
+        async with AsyncSession(async_engine) as session:
+            # The flooded chat's rows are the oldest, so they head the claim ordering
+            for minutes, chat_id in ((3, flooded_chat), (2, flooded_chat), (1, OTHER_CHAT)):
+                session.add(self2.ScheduledMessage(
+                    user_id=1, chat_id=chat_id, send_time=now - timedelta(minutes=minutes), message_text="hi"
+                ))
+            await session.commit()
+
+    async def send(row):
+        return self2.SEND_DEFERRED if self2.is_flood_limited(row.chat_id) else self2.SEND_DONE
+
+    asyncio.run(add_rows())
+    count, outcomes = run_pass(self2, async_engine, send, now)
+    assert count == 2
+    assert sorted(outcomes.deferred_ids) == [flooded_chat]
+
+    count, outcomes = run_pass(self2, async_engine, send, now)
+    assert count == 1
+    assert len(outcomes.done_ids) == 1
+
+    async def load_rows():
+        async with AsyncSession(async_engine) as session:
+            return (await session.execute(select(self2.ScheduledMessage))).scalars().all()
+
+    for row in asyncio.run(load_rows()):
+        if row.chat_id == flooded_chat:
+            # Parked until the flood is over, without using up a retry
+            assert not row.is_sent and row.retry_count == 0
+            assert row.next_retry_at > now + timedelta(seconds=50)
+        else:
+            assert row.is_sent
@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("pyrogram")
+pytest.importorskip("sqlmodel")
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+# The usersetting table as the baseline release created it (user_id was UNIQUE)
+BASELINE_USERSETTING_SCHEMA = (
+    """
+    CREATE TABLE usersetting (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        "key" VARCHAR NOT NULL,
+        value VARCHAR NOT NULL,
+        PRIMARY KEY (id)
+    )
+    """,
+    "CREATE UNIQUE INDEX ix_usersetting_user_id ON usersetting (user_id)",
+)
+
+
+@pytest.fixture
+def baseline_engine(self2, tmp_path, monkeypatch):
+    """
+    An engine on a database created with the baseline schema, upgraded by create_db_and_tables().
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with engine.begin() as conn:
+        for ddl in BASELINE_USERSETTING_SCHEMA:
+            conn.execute(text(ddl))
+    monkeypatch.setattr(self2, "engine", engine)
+    self2.create_db_and_tables()
+    yield engine
+    engine.dispose()
+
+
+def test_upgrade_makes_user_id_index_non_unique(baseline_engine):
+    indexes = {index["name"]: index for index in inspect(baseline_engine).get_indexes("usersetting")}
+    assert not indexes["ix_usersetting_user_id"]["unique"]
+    assert indexes["ix_usersetting_user_key"]["unique"]
+
+
+def test_upgraded_db_stores_several_keys_per_user(self2, baseline_engine):
+    with Session(baseline_engine) as session:
+        session.add(self2.UserSetting(user_id=1, key="first", value="1"))
+        session.add(self2.UserSetting(user_id=1, key="second", value="2"))
+        session.commit()
+
+
+def test_upgraded_db_still_rejects_duplicate_user_key(self2, baseline_engine):
+    with Session(baseline_engine) as session:
+        session.add(self2.UserSetting(user_id=1, key="same", value="1"))
+        session.add(self2.UserSetting(user_id=1, key="same", value="2"))
+        with pytest.raises(IntegrityError):
+            session.commit()